@@ -0,0 +1,3 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmarks of magic-marker on synthetic test trees, see benchmarks/run.py"""
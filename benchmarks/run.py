@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+"""Run the benchmarks on a synthetic test tree and report the results in a comparable format
+
+Every case runs against a fresh copy of the tree in the temp directory, nothing touches the network:
+
+    $ python -m benchmarks.run --files 200 --output results.json
+    $ python -m benchmarks.run --files 200 --compare results.json
+"""
+# ======================================================================================================================
+# Imports
+# ======================================================================================================================
+from __future__ import absolute_import, print_function
+from benchmarks.synthetic import TreeShape, make_tree
+from magic_marker.magic_marker import MagicMarker
+from magic_marker.detector import AstDetector
+from magic_marker.backup import Backup, ArchiveBackup, BackupStore, StoreBackup
+from magic_marker.timing import clock
+import magic_marker.magic_marker
+import contextlib
+import argparse
+import platform
+import tempfile
+import shutil
+import json
+import sys
+import os
+
+# ======================================================================================================================
+# Globals
+# ======================================================================================================================
+RESULTS_VERSION = 1
+
+
+class Case(object):
+    """A benchmark, timing one operation against a fresh synthetic tree"""
+
+    def __init__(self, name, run, unit):
+        """Create a new Case object
+
+        Args:
+            name (str): the name of the case, stable between versions so results stay comparable
+            run (callable): called with the tree, runs the operation and returns the seconds it took and the
+                            number of units it handled
+            unit (str): what the throughput is counted in
+        """
+        self.name = name
+        self.run = run
+        self.unit = unit
+
+    def measure(self, shape, repeat):
+        """Time the case
+
+        Args:
+            shape (TreeShape): the shape of the tree to run against
+            repeat (int): the number of times to run the case
+
+        Returns:
+            dict: the result
+        """
+        times = []
+        units = 0
+        for _ in range(repeat):
+            with _tree(shape) as tree:
+                seconds, units = self.run(tree)
+            times.append(seconds)
+        times.sort()
+        return {'name': self.name,
+                'repeat': repeat,
+                'min': times[0],
+                'median': times[len(times) // 2],
+                'max': times[-1],
+                'units': units,
+                'unit': self.unit,
+                'per_second': units / times[0] if times[0] else None}
+
+
+def cases(jobs=1):
+    """The benchmark cases
+
+    Args:
+        jobs (int): the number of worker processes of the end-to-end runs
+
+    Returns:
+        list[Case]
+    """
+    found = [Case('mark[{}]'.format(engine), _mark_case(engine, jobs), 'tests') for engine in MagicMarker.engines]
+    found.append(Case('fix_file', _fix_file_case, 'marks'))
+    found.extend(Case('backup[{}]'.format(strategy), _backup_case(strategy), 'files') for strategy in Backup.strategies)
+    found.extend(Case('backup[{}]'.format(fmt), _archive_case(fmt), 'files') for fmt in ('tar.gz', 'store'))
+    found.append(Case('options[flake8]', _options_case(cached=None), 'configs'))
+    found.append(Case('options[disk cache]', _options_case(cached='disk'), 'configs'))
+    found.append(Case('options[memory cache]', _options_case(cached='memory'), 'configs'))
+    return found
+
+
+def _mark_case(engine, jobs):
+    """End-to-end run_flake8_and_mark, config discovery and the backup included"""
+    def run(tree):
+        mm = MagicMarker(engine=engine, jobs=jobs)
+        start = clock()
+        mm.run_flake8_and_mark(tree['root'], tree['config'])
+        seconds = clock() - start
+        _remove(mm.backup_path)
+        return seconds, tree['tests']
+    return run
+
+
+def _fix_file_case(tree):
+    """MagicMarker._fix_file on its own, the violations are found before the timer starts"""
+    mm = MagicMarker(engine='ast', jobs=1)
+    mm.find_options(tree['config'])
+    detector = AstDetector(mm.options)
+    violations = [v for v in (detector.check_file(f) for f in tree['files']) if v]
+    start = clock()
+    marks = sum(mm._fix_file(fixes_required).count for fixes_required in violations)
+    return clock() - start, marks
+
+
+def _backup_case(strategy):
+    """A full backup of the tree as a directory"""
+    def run(tree):
+        backup_path = tempfile.mkdtemp(prefix='magic_marker_bench_backup_')
+        os.rmdir(backup_path)
+        backup = Backup(backup_path, tree['root'], strategy)
+        start = clock()
+        backup.add_tree()
+        backup.close()
+        seconds = clock() - start
+        _remove(backup_path)
+        return seconds, len(tree['files'])
+    return run
+
+
+def _archive_case(backup_format):
+    """A full backup of the tree as a compressed tar or into a fresh backup store"""
+    def run(tree):
+        scratch = tempfile.mkdtemp(prefix='magic_marker_bench_backup_')
+        if backup_format == 'store':
+            backup = StoreBackup(tree['root'], BackupStore(os.path.join(scratch, 'store')), 'bench')
+        else:
+            backup = ArchiveBackup(os.path.join(scratch, 'backup.' + backup_format), tree['root'], backup_format)
+        start = clock()
+        backup.add_tree()
+        backup.close()
+        seconds = clock() - start
+        _remove(scratch)
+        return seconds, len(tree['files'])
+    return run
+
+
+def _options_case(cached):
+    """Config discovery by find_options, through flake8 or one of the caches"""
+    def run(tree):
+        cache_dir = os.path.join(tree['root'], '.magic_marker_cache')
+        mm = MagicMarker(cache_dir=cache_dir if cached == 'disk' else None)
+        if cached:
+            mm.find_options(tree['config'])
+        if cached != 'memory':
+            magic_marker.magic_marker._options_cache.clear()
+        start = clock()
+        mm.find_options(tree['config'])
+        return clock() - start, 1
+    return run
+
+
+@contextlib.contextmanager
+def _tree(shape):
+    """A fresh synthetic tree in the temp directory, removed afterwards
+
+    Args:
+        shape (TreeShape): the shape of the tree
+
+    Yields:
+        dict: the tree as described by make_tree, with its 'root'
+    """
+    root = tempfile.mkdtemp(prefix='magic_marker_bench_')
+    try:
+        tree = make_tree(root, shape)
+        tree['root'] = root
+        yield tree
+    finally:
+        _remove(root)
+
+
+def _remove(path):
+    """Remove a file or directory, if it exists
+
+    Args:
+        path (str): the path
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def run_benchmarks(shape, repeat=3, only=None, jobs=1):
+    """Run the benchmark cases
+
+    Args:
+        shape (TreeShape): the shape of the tree
+        repeat (int): the number of times to run each case, the fastest run is the one compared
+        only (list[str]): run only the cases whose name starts with one of these
+        jobs (int): the number of worker processes of the end-to-end runs
+
+    Returns:
+        dict: the environment, the shape of the tree and the result of each case
+    """
+    results = []
+    for case in cases(jobs):
+        if only and not any(case.name.startswith(prefix) for prefix in only):
+            continue
+        results.append(case.measure(shape, repeat))
+    return {'version': RESULTS_VERSION,
+            'magic_marker': magic_marker.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'shape': shape.to_dict(),
+            'jobs': jobs,
+            'results': results}
+
+
+def format_results(results, baseline=None):
+    """Render results as a table, next to a baseline when given
+
+    Args:
+        results (dict): the results of run_benchmarks
+        baseline (dict): earlier results of run_benchmarks to compare against
+
+    Returns:
+        str
+    """
+    lines = ['{:<24}{:>12}{:>12}{:>20}'.format('Case', 'Min (s)', 'Median (s)', 'Per second')]
+    if baseline:
+        lines[0] += '{:>14}'.format('vs baseline')
+        before = {result['name']: result for result in baseline['results']}
+    for result in results['results']:
+        line = '{:<24}{:>12.4f}{:>12.4f}{:>20}'.format(result['name'], result['min'], result['median'],
+                                                       '{:.1f} {}'.format(result['per_second'] or 0, result['unit']))
+        if baseline and result['name'] in before and result['min']:
+            line += '{:>13.2f}x'.format(before[result['name']]['min'] / result['min'])
+        lines.append(line)
+    if baseline and baseline.get('shape') != results['shape']:
+        lines.append('Warning: the baseline was measured on a tree of another shape')
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """Run the benchmarks from the command line
+
+    Args:
+        argv (list[str]): the command line arguments, defaults to sys.argv
+
+    Returns:
+        int: the exit code
+    """
+    defaults = TreeShape()
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run', description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=defaults.files, help='Test files in the tree.')
+    parser.add_argument('--tests-per-file', type=int, default=defaults.tests_per_file, help='Tests in each file.')
+    parser.add_argument('--marked', type=float, default=defaults.marked, help='Share of the tests already marked.')
+    parser.add_argument('--nesting', type=int, default=defaults.nesting, help='Depth of the test classes.')
+    parser.add_argument('--body-lines', type=int, default=defaults.body_lines, help='Statements in each test.')
+    parser.add_argument('--seed', type=int, default=defaults.seed, help='Seed of the tree.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each case, the fastest is reported.')
+    parser.add_argument('--jobs', type=int, default=1, help='Worker processes of the end-to-end runs.')
+    parser.add_argument('--only', action='append', help='Run only the cases starting with this, may be repeated.')
+    parser.add_argument('--output', help='Save the results as JSON to this file.')
+    parser.add_argument('--compare', help='Compare against the results saved by an earlier run.')
+    args = parser.parse_args(argv)
+
+    shape = TreeShape(args.files, args.tests_per_file, args.marked, args.nesting, args.body_lines, seed=args.seed)
+    results = run_benchmarks(shape, args.repeat, args.only, args.jobs)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    print(format_results(results, baseline))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())  # pragma: no cover
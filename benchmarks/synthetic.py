@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""Generate synthetic test trees of any size, reproducibly, for the benchmarks"""
+# ======================================================================================================================
+# Imports
+# ======================================================================================================================
+from __future__ import absolute_import
+import random
+import uuid
+import os
+
+# ======================================================================================================================
+# Globals
+# ======================================================================================================================
+CONFIG = """[flake8]
+pytest_mark1 = name=test_id,
+               value_match=uuid,
+               exclude_classes=true
+"""
+MARK_NAME = 'test_id'
+HEADER = """#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import pytest
+
+"""
+
+
+class TreeShape(object):
+    """The shape of a synthetic test tree"""
+
+    def __init__(self, files=50, tests_per_file=20, marked=0.5, nesting=0, body_lines=3, files_per_dir=20, seed=0):
+        """Create a new TreeShape object
+
+        Args:
+            files (int): the number of test files
+            tests_per_file (int): the number of tests in each file
+            marked (float): the share of tests already marked, between 0 and 1
+            nesting (int): the depth of the test classes holding the tests, 0 for module level test functions
+            body_lines (int): the number of statements in each test, which sets the size of the files
+            files_per_dir (int): the number of files in each directory of the tree
+            seed (int): the seed of the choice of marked tests and of their IDs
+        """
+        if not 0 <= marked <= 1:
+            raise ValueError("the share of marked tests must be between 0 and 1, not {}".format(marked))
+        self.files = files
+        self.tests_per_file = tests_per_file
+        self.marked = marked
+        self.nesting = nesting
+        self.body_lines = body_lines
+        self.files_per_dir = files_per_dir
+        self.seed = seed
+
+    def to_dict(self):
+        """The shape as plain data
+
+        Returns:
+            dict
+        """
+        return dict(self.__dict__)
+
+
+def make_tree(root, shape):
+    """Write a synthetic test tree and the flake8 config marking it
+
+    Args:
+        root (str): the directory to write the tree to, created if missing
+        shape (TreeShape): the shape of the tree
+
+    Returns:
+        dict: the config path, the paths of the files, and the number of tests and of unmarked tests
+    """
+    rng = random.Random(shape.seed)
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    config = os.path.join(root, 'tox.ini')
+    with open(config, 'w') as f:
+        f.write(CONFIG)
+
+    filenames = []
+    unmarked = 0
+    for number in range(shape.files):
+        directory = os.path.join(root, 'tests_{:03d}'.format(number // shape.files_per_dir))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        filename = os.path.join(directory, 'test_synthetic_{:05d}.py'.format(number))
+        source, file_unmarked = make_module(shape, rng)
+        with open(filename, 'w') as f:
+            f.write(source)
+        filenames.append(filename)
+        unmarked += file_unmarked
+    return {'config': config,
+            'files': filenames,
+            'tests': shape.files * shape.tests_per_file,
+            'unmarked': unmarked}
+
+
+def make_module(shape, rng):
+    """Generate the source of a single test file
+
+    Args:
+        shape (TreeShape): the shape of the tree
+        rng (random.Random): the source of the choice of marked tests and of their IDs
+
+    Returns:
+        tuple(str, int): the source and the number of unmarked tests in it
+    """
+    lines = [HEADER]
+    indent = ''
+    for depth in range(shape.nesting):
+        lines.append('\n{}class TestGroup{}(object):\n'.format(indent, depth))
+        indent += '    '
+    unmarked = 0
+    for number in range(shape.tests_per_file):
+        lines.append('\n')
+        if rng.random() < shape.marked:
+            value = uuid.UUID(int=rng.getrandbits(128), version=1)
+            lines.append("{}@pytest.mark.{}('{}')\n".format(indent, MARK_NAME, value))
+        else:
+            unmarked += 1
+        lines.append('{}def test_case_{:04d}({}):\n'.format(indent, number, 'self' if shape.nesting else ''))
+        lines.append('{}    """Synthetic test {}"""\n'.format(indent, number))
+        for line in range(shape.body_lines):
+            lines.append('{}    value_{} = {} * {}\n'.format(indent, line, number, line))
+        lines.append('{}    assert True\n'.format(indent))
+    return ''.join(lines), unmarked
@@ -0,0 +1,558 @@
+# -*- coding: utf-8 -*-
+
+"""Backups of the files MagicMarker rewrites"""
+# ======================================================================================================================
+# Imports
+# ======================================================================================================================
+from __future__ import absolute_import
+import tempfile
+import time
+import hashlib
+import shutil
+import json
+import os
+
+
+# ======================================================================================================================
+# Globals
+# ======================================================================================================================
+FICLONE = 0x40049409  # linux/fs.h, _IOW(0x94, 9, int)
+
+
+class Backup(object):
+    """A backup of a target, either of the whole target or of individual files as they are about to be rewritten
+
+    When individual files of a directory are backed up their layout relative to the target is kept and they are
+    recorded in a manifest. A target that is a single file is backed up to the backup path itself.
+
+    Files are copied with one of the following strategies, each falling back to a plain copy when it is not supported:
+        copy:     a plain copy of every byte
+        reflink:  a copy-on-write clone (FICLONE) or an in-kernel copy (copy_file_range)
+        hardlink: a hard link, only safe when the fixed files are replaced rather than written in place
+    """
+
+    manifest_name = 'manifest.json'
+    strategies = ('copy', 'reflink', 'hardlink')
+
+    def __init__(self, backup_path, target, strategy='copy'):
+        """Create a new Backup object
+
+        Args:
+            backup_path (str): the location of the backup
+            target (str): the file or directory being fixed
+            strategy (str): how files are copied, one of Backup.strategies
+        """
+        if strategy not in self.strategies:
+            raise RuntimeError("Magic Marker does not know the backup strategy '{}'".format(strategy))
+        self._backup_path = backup_path
+        self._target = target
+        self._strategy = strategy
+        self._root = target if os.path.isdir(target) else os.path.dirname(os.path.abspath(target))
+        self._files = []
+        self._added = set()  # the files already backed up, relative to the target, a file is only backed up once
+
+    @property
+    def backup_path(self):
+        return self._backup_path
+
+    @property
+    def files(self):
+        """The files backed up individually, relative to the target
+
+        Returns:
+            list[str]
+        """
+        return list(self._files)
+
+    def add_tree(self):
+        """Backup the entire target"""
+        try:
+            if not os.path.isdir(self._target):
+                # its a single file
+                self._copy_file(self._target, self._backup_path)
+            elif self._strategy == 'copy':
+                shutil.copytree(self._target, self._backup_path)
+            else:
+                self._copy_tree()
+        except (IOError, OSError):
+            raise RuntimeError("Magic Marker was not able to backup the target {}".format(self._target))
+        if not os.path.isdir(self._target):
+            self._added.add(self._relative(self._target))
+            return
+        for root, dirs, files in os.walk(self._backup_path):
+            for name in files:
+                self._added.add(os.path.relpath(os.path.join(root, name), self._backup_path))
+
+    def _copy_tree(self):
+        """Recreate the target directory tree in the backup, copying each file with the chosen strategy"""
+        for root, dirs, files in os.walk(self._target):
+            destination = os.path.join(self._backup_path, os.path.relpath(root, self._target))
+            os.makedirs(destination)
+            for name in files:
+                self._copy_file(os.path.join(root, name), os.path.join(destination, name))
+
+    def add(self, filename):
+        """Backup a single file of the target, unless it was backed up already so the backup keeps its original content
+
+        Args:
+            filename (str): the path of the file to copy
+        """
+        relative = self._relative(filename)
+        if relative in self._added:
+            return
+        if not os.path.isdir(self._target):
+            self.add_tree()
+            return
+        destination = os.path.join(self._backup_path, relative)
+        try:
+            if not os.path.isdir(os.path.dirname(destination)):
+                os.makedirs(os.path.dirname(destination))
+            self._copy_file(filename, destination)
+        except (IOError, OSError):
+            raise RuntimeError("Magic Marker was not able to backup the file {}".format(filename))
+        self._files.append(relative)
+        self._added.add(relative)
+
+    def _relative(self, filename):
+        """The path a file is recorded under in the backup
+
+        Args:
+            filename (str): the path of a file of the target
+
+        Returns:
+            str
+        """
+        if os.path.isdir(self._target):
+            return os.path.relpath(filename, self._root)
+        return os.path.basename(filename)
+
+    def close(self):
+        """Write the manifest of the individually backed up files"""
+        if not self._files:
+            return
+        with open(os.path.join(self._backup_path, self.manifest_name), 'w') as f:
+            json.dump({'target': os.path.abspath(self._target), 'files': self._files}, f, indent=2)
+
+    def _copy_file(self, source, destination):
+        """Copy a single file with the chosen strategy
+
+        Args:
+            source (str): the path of the file to copy
+            destination (str): the path of the copy
+        """
+        if self._strategy == 'hardlink':
+            try:
+                os.link(source, destination)
+                return
+            except OSError:
+                pass  # ex: crossing filesystems, fall back to a copy
+        elif self._strategy == 'reflink':
+            try:
+                _clone_file(source, destination)
+                shutil.copystat(source, destination)
+                return
+            except (IOError, OSError, ImportError, AttributeError):
+                pass  # the filesystem or platform does not support it, fall back to a copy
+        shutil.copy2(source, destination)
+
+
+class ArchiveBackup(Backup):
+    """A backup written in a single pass into one compressed tar
+
+    A manifest recording the path, SHA-256 and size of every file backed up is written next to the archive, so it can
+    be read without decompressing the archive. Once an archive is finished the older archives of the same directory,
+    the ones with a manifest, are dropped beyond the retention policy.
+    """
+
+    formats = ('tar.gz', 'tar.xz')
+    manifest_suffix = '.manifest.json'
+
+    def __init__(self, backup_path, target, backup_format='tar.gz', keep_runs=None, max_size=None):
+        """Create a new ArchiveBackup object
+
+        Args:
+            backup_path (str): the location of the archive
+            target (str): the file or directory being fixed
+            backup_format (str): the kind of archive, one of ArchiveBackup.formats
+            keep_runs (int): the number of most recent archives to keep, every archive is kept if None
+            max_size (int): the number of bytes of archives to keep at most, older archives are dropped to make room
+        """
+        if backup_format not in self.formats:
+            raise RuntimeError("Magic Marker does not know the backup format '{}'".format(backup_format))
+        super(ArchiveBackup, self).__init__(backup_path, target)
+        self._mode = 'w:{}'.format(backup_format.split('.')[1])
+        self._archive = None
+        self._manifest = []
+        self.keep_runs = keep_runs
+        self.max_size = max_size
+
+    @property
+    def manifest_path(self):
+        """The location of the manifest written next to the archive
+
+        Returns:
+            str
+        """
+        return self._backup_path + self.manifest_suffix
+
+    def add_tree(self):
+        """Backup the entire target"""
+        if not os.path.isdir(self._target):
+            self.add(self._target)
+            return
+        for root, dirs, files in os.walk(self._target):
+            for name in sorted(files):
+                self.add(os.path.join(root, name))
+
+    def add(self, filename):
+        """Backup a single file of the target
+
+        Args:
+            filename (str): the path of the file to add to the archive
+        """
+        relative = self._relative(filename)
+        if relative in self._added:
+            return
+        import tarfile
+        try:
+            if self._archive is None:
+                self._archive = tarfile.open(self._backup_path, self._mode)
+            with open(filename, 'rb') as f:
+                reader = _HashingReader(f)
+                info = self._archive.gettarinfo(fileobj=f, arcname=relative)
+                self._archive.addfile(info, reader)
+        except (IOError, OSError, tarfile.TarError):
+            raise RuntimeError("Magic Marker was not able to backup the file {}".format(filename))
+        self._files.append(relative)
+        self._added.add(relative)
+        self._manifest.append({'path': relative, 'sha256': reader.hexdigest(), 'size': info.size})
+
+    def close(self):
+        """Finish the archive, write its manifest and apply the retention policy"""
+        if self._archive is None:
+            return
+        self._archive.close()
+        self._archive = None
+        with open(self.manifest_path, 'w') as f:
+            json.dump({'target': os.path.abspath(self._target),
+                       'created': time.time(),
+                       'archive': os.path.basename(self._backup_path),
+                       'files': self._manifest}, f, indent=2)
+        self.collect()
+
+    def collect(self):
+        """Drop the oldest archives of the directory of this one beyond the retention policy
+
+        Only the archives with a manifest are considered, an archive still being written has none yet. The most recent
+        archive is always kept.
+
+        Returns:
+            int: the number of archives deleted
+        """
+        archives = []  # (created, path of the archive, size)
+        directory = os.path.dirname(os.path.abspath(self._backup_path))
+        for name in os.listdir(directory):
+            if not name.endswith(self.manifest_suffix):
+                continue
+            try:
+                with open(os.path.join(directory, name), 'r') as f:
+                    manifest = json.load(f)
+                if manifest['archive'] + self.manifest_suffix != name:
+                    continue  # not the manifest of an archive
+                archive = os.path.join(directory, manifest['archive'])
+                archives.append((manifest['created'], archive, os.path.getsize(archive)))
+            except (IOError, OSError, ValueError, KeyError, TypeError):
+                continue  # not the manifest of an archive, or it is being collected by another run
+        archives.sort()
+        deleted = 0
+        while len(archives) > 1 and ((self.keep_runs is not None and len(archives) > self.keep_runs) or
+                                     (self.max_size is not None and sum(a[2] for a in archives) > self.max_size)):
+            archive = archives.pop(0)[1]
+            for path in (archive + self.manifest_suffix, archive):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass  # removed by another run
+            deleted += 1
+        return deleted
+
+
+class BackupStore(object):
+    """A persistent, content-addressed store of backups shared by every run
+
+    Files are kept once per distinct content as blobs named by their SHA-256, each run records a manifest of the
+    blobs it needs. Runs beyond the retention policy are forgotten and blobs no run refers to are deleted.
+
+    A run holds a shared lock on the store from its first blob until its manifest is written, collection needs an
+    exclusive lock and is skipped while another run holds the store, the last run to finish collects instead.
+    """
+
+    lock_name = 'lock'
+
+    def __init__(self, store_dir=None, keep_runs=10, max_size=None):
+        """Create a new BackupStore object
+
+        Args:
+            store_dir (str): the directory of the store, defaults to 'magic_marker_store' in the temp directory
+            keep_runs (int): the number of most recent runs to keep
+            max_size (int): the number of bytes of blobs to keep at most, older runs are dropped to make room
+        """
+        self.store_dir = store_dir or os.path.join(tempfile.gettempdir(), 'magic_marker_store')
+        self.keep_runs = keep_runs
+        self.max_size = max_size
+        self._blobs_dir = os.path.join(self.store_dir, 'blobs')
+        self._runs_dir = os.path.join(self.store_dir, 'runs')
+
+    def run_path(self, run_name):
+        """The location of the manifest of a run
+
+        Args:
+            run_name (str): the name of the run
+
+        Returns:
+            str
+        """
+        return os.path.join(self._runs_dir, '{}.json'.format(run_name))
+
+    def blob_path(self, digest):
+        """The location of a blob
+
+        Args:
+            digest (str): the SHA-256 of the content
+
+        Returns:
+            str
+        """
+        return os.path.join(self._blobs_dir, digest[:2], digest)
+
+    def lock(self, exclusive=False):
+        """Lock the store, waiting for a shared lock but never for an exclusive one
+
+        Args:
+            exclusive (bool): lock the store for collection rather than for writing a run
+
+        Returns:
+            file: the open lock file, closing it releases the lock, None when an exclusive lock could not be taken
+                right away. The store is not locked on a platform without fcntl (ex: Windows).
+        """
+        if not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+        lock_file = open(os.path.join(self.store_dir, self.lock_name), 'a')
+        try:
+            import fcntl
+        except ImportError:
+            return lock_file
+        try:
+            fcntl.flock(lock_file.fileno(), (fcntl.LOCK_EX | fcntl.LOCK_NB) if exclusive else fcntl.LOCK_SH)
+        except (IOError, OSError):
+            lock_file.close()
+            if not exclusive:
+                raise
+            return None
+        return lock_file
+
+    def put(self, filename):
+        """Store the content of a file unless it is already stored, the caller must hold a lock on the store
+
+        Args:
+            filename (str): the path of the file
+
+        Returns:
+            tuple(str, int): the SHA-256 and size of the content
+        """
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+        blob = self.blob_path(digest)
+        if not os.path.exists(blob):
+            if not os.path.isdir(os.path.dirname(blob)):
+                os.makedirs(os.path.dirname(blob))
+            temp_path = '{}.{}.tmp'.format(blob, os.getpid())
+            shutil.copyfile(filename, temp_path)
+            os.rename(temp_path, blob)  # never leave a partial blob behind under its final name
+        return digest, os.path.getsize(blob)
+
+    def runs(self):
+        """The manifests of the stored runs, oldest first
+
+        Returns:
+            list[tuple(str, dict)]: the path and content of each manifest
+        """
+        if not os.path.isdir(self._runs_dir):
+            return []
+        runs = []
+        for name in os.listdir(self._runs_dir):
+            if name.endswith('.json'):
+                path = os.path.join(self._runs_dir, name)
+                with open(path, 'r') as f:
+                    runs.append((path, json.load(f)))
+        runs.sort(key=lambda run: (run[1].get('created', 0), run[0]))
+        return runs
+
+    def collect(self):
+        """Apply the retention policy and delete the blobs that are no longer referenced
+
+        The most recent run is always kept. A run still in progress has no manifest yet, so nothing is collected while
+        another run holds a lock on the store, see BackupStore.lock.
+
+        Returns:
+            int: the number of blobs deleted
+        """
+        lock_file = self.lock(exclusive=True)
+        if lock_file is None:
+            return 0
+        with lock_file:
+            return self._collect()
+
+    def _collect(self):
+        """Apply the retention policy and delete the blobs that are no longer referenced, holding an exclusive lock
+
+        Returns:
+            int: the number of blobs deleted
+        """
+        runs = self.runs()
+        while len(runs) > max(self.keep_runs, 1):
+            os.remove(runs.pop(0)[0])
+        if self.max_size is not None:
+            while len(runs) > 1 and self._referenced_size(runs) > self.max_size:
+                os.remove(runs.pop(0)[0])
+
+        referenced = set(entry['sha256'] for run in runs for entry in run[1]['files'])
+        deleted = 0
+        if os.path.isdir(self._blobs_dir):
+            for root, dirs, files in os.walk(self._blobs_dir):
+                for name in files:
+                    if name not in referenced:
+                        os.remove(os.path.join(root, name))
+                        deleted += 1
+        return deleted
+
+    @staticmethod
+    def _referenced_size(runs):
+        """The number of bytes of the distinct blobs referenced by runs
+
+        Args:
+            runs (list[tuple(str, dict)]): the runs
+
+        Returns:
+            int
+        """
+        sizes = dict((entry['sha256'], entry['size']) for run in runs for entry in run[1]['files'])
+        return sum(sizes.values())
+
+
+class StoreBackup(Backup):
+    """A backup kept in a BackupStore, only content the store has not seen before is written
+
+    The backup path is the manifest of the run inside of the store.
+    """
+
+    def __init__(self, target, store, run_name):
+        """Create a new StoreBackup object
+
+        Args:
+            target (str): the file or directory being fixed
+            store (BackupStore): the store to keep the backup in
+            run_name (str): the unique name of this run
+        """
+        super(StoreBackup, self).__init__(store.run_path(run_name), target)
+        self._store = store
+        self._manifest = []
+        self._lock_file = None  # a shared lock on the store from the first blob put until the manifest is written
+
+    def add_tree(self):
+        """Backup the entire target"""
+        if not os.path.isdir(self._target):
+            self.add(self._target)
+            return
+        for root, dirs, files in os.walk(self._target):
+            for name in sorted(files):
+                self.add(os.path.join(root, name))
+
+    def add(self, filename):
+        """Backup a single file of the target
+
+        Args:
+            filename (str): the path of the file to store
+        """
+        relative = self._relative(filename)
+        if relative in self._added:
+            return
+        try:
+            if self._lock_file is None:
+                self._lock_file = self._store.lock()
+            digest, size = self._store.put(filename)
+        except (IOError, OSError):
+            raise RuntimeError("Magic Marker was not able to backup the file {}".format(filename))
+        self._files.append(relative)
+        self._added.add(relative)
+        self._manifest.append({'path': relative, 'sha256': digest, 'size': size})
+
+    def close(self):
+        """Write the manifest of the run, release the store and apply its retention policy"""
+        if self._lock_file is None:
+            return
+        try:
+            if not self._manifest:
+                return  # nothing could be stored
+            if not os.path.isdir(os.path.dirname(self._backup_path)):
+                os.makedirs(os.path.dirname(self._backup_path))
+            with open(self._backup_path, 'w') as f:
+                json.dump({'target': os.path.abspath(self._target),
+                           'created': time.time(),
+                           'store': self._store.store_dir,
+                           'files': self._manifest}, f, indent=2)
+        finally:
+            self._lock_file.close()
+            self._lock_file = None
+        self._store.collect()
+
+
+class _HashingReader(object):
+    """Wraps a binary file, hashing everything that is read through it"""
+
+    def __init__(self, f):
+        """Create a new _HashingReader object
+
+        Args:
+            f (file): the binary file to read
+        """
+        self._f = f
+        self._digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self._digest.update(data)
+        return data
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+
+def _clone_file(source, destination):
+    """Clone a file with a copy-on-write reflink, or failing that with an in-kernel copy
+
+    Args:
+        source (str): the path of the file to clone
+        destination (str): the path of the clone
+
+    Raises:
+        OSError: neither a reflink nor an in-kernel copy is supported
+        ImportError: the platform has no fcntl
+    """
+    import fcntl
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except (IOError, OSError):
+            pass
+        size = os.fstat(src.fileno()).st_size
+        copied = 0
+        while copied < size:
+            count = os.copy_file_range(src.fileno(), dst.fileno(), size - copied)  # raises AttributeError before 3.8
+            if not count:
+                break
+            copied += count
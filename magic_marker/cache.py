@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+"""On-disk caches of the files that were found to have nothing to fix and of the mark configuration"""
+# ======================================================================================================================
+# Imports
+# ======================================================================================================================
+from __future__ import absolute_import
+from magic_marker import __version__
+import hashlib
+import json
+import os
+
+
+class FileCache(object):
+    """Remembers the files that had nothing to fix, keyed by path
+
+    An entry is only trusted while the content of the file and the mark configuration are unchanged.
+    """
+
+    cache_file = 'files.json'
+
+    def __init__(self, cache_dir, fingerprint):
+        """Create a new FileCache object, loading any previous results
+
+        Args:
+            cache_dir (str): the directory the cache is kept in
+            fingerprint (str): the fingerprint of the mark configuration, see FileCache.fingerprint
+        """
+        self._cache_dir = cache_dir
+        self._fingerprint = fingerprint
+        self._entries = {}
+        self._dirty = False
+        try:
+            with open(os.path.join(cache_dir, self.cache_file), 'r') as f:
+                data = json.load(f)
+            if data.get('version') == __version__:
+                self._entries = data['files']
+        except (IOError, OSError, ValueError, KeyError):
+            pass  # a missing or unreadable cache is an empty cache
+
+    @staticmethod
+    def fingerprint(options):
+        """Generate a fingerprint of the mark configuration
+
+        Args:
+            options (dict): mark config name (key), dict (value) as found by MagicMarker.find_options
+
+        Returns:
+            str: the fingerprint
+        """
+        return hashlib.sha256(json.dumps(options, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def file_hash(filename):
+        """Hash the content of a file
+
+        Args:
+            filename (str): the path of the file
+
+        Returns:
+            str: the SHA-256 hex digest of the file
+        """
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def is_clean(self, filename):
+        """Check whether a file is known to have nothing to fix
+
+        The content is only hashed when the size matches but the mtime does not
+
+        Args:
+            filename (str): the path of the file
+
+        Returns:
+            bool
+        """
+        entry = self._entries.get(os.path.abspath(filename))
+        if not entry or entry['config'] != self._fingerprint:
+            return False
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return False
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime == entry['mtime']:
+            return True
+        if self.file_hash(filename) == entry['sha256']:
+            entry['mtime'] = stat.st_mtime
+            self._dirty = True
+            return True
+        return False
+
+    def mark_clean(self, filename):
+        """Record that a file has nothing to fix
+
+        Args:
+            filename (str): the path of the file
+        """
+        stat = os.stat(filename)
+        self._entries[os.path.abspath(filename)] = {'sha256': self.file_hash(filename),
+                                                    'mtime': stat.st_mtime,
+                                                    'size': stat.st_size,
+                                                    'config': self._fingerprint}
+        self._dirty = True
+
+    def save(self):
+        """Write the cache to disk if it changed"""
+        if not self._dirty:
+            return
+        _make_cache_dir(self._cache_dir)
+        path = os.path.join(self._cache_dir, self.cache_file)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'version': __version__, 'files': self._entries}, f)
+        os.rename(path + '.tmp', path)
+        self._dirty = False
+
+
+class OptionsCache(object):
+    """Remembers the options found by flake8, keyed by OptionsCache.key"""
+
+    cache_file = 'options.json'
+    layout = 2  # of the options recorded, entries of an earlier layout are never matched
+
+    def __init__(self, cache_dir):
+        """Create a new OptionsCache object, loading any previous results
+
+        Args:
+            cache_dir (str): the directory the cache is kept in
+        """
+        self._path = os.path.join(cache_dir, self.cache_file)
+        self._cache_dir = cache_dir
+        try:
+            with open(self._path, 'r') as f:
+                self._entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            self._entries = {}  # a missing or unreadable cache is an empty cache
+
+    @staticmethod
+    def key(config):
+        """Generate a key identifying the configuration flake8 would load
+
+        The key covers every config file flake8 would consider, whether or not it exists yet, together with their
+        mtimes and sizes, and the versions of flake8 and the plug-ins that define the options.
+
+        Args:
+            config (str): the path to the authoritative config file, or None to let flake8 discover them
+
+        Returns:
+            str: the key
+        """
+        import flake8
+        import flake8_pytest_mark
+        files = []
+        for filename in [os.path.abspath(config)] if config else _discoverable_config_files():
+            try:
+                stat = os.stat(filename)
+                files.append([filename, stat.st_mtime, stat.st_size])
+            except OSError:
+                files.append([filename, None, None])
+        return json.dumps({'files': files,
+                           'layout': OptionsCache.layout,
+                           'versions': [__version__, flake8.__version__, flake8_pytest_mark.__version__]},
+                          sort_keys=True)
+
+    def get(self, key):
+        """Look up the options for a key
+
+        Args:
+            key (str): the key, see OptionsCache.key
+
+        Returns:
+            dict: the options or None
+        """
+        return self._entries.get(key)
+
+    def put(self, key, options):
+        """Record the options for a key
+
+        Args:
+            key (str): the key, see OptionsCache.key
+            options (dict): the options, see MagicMarker._load_options
+        """
+        self._entries = {key: options}  # only the configuration of the latest run is worth keeping
+        _make_cache_dir(self._cache_dir)
+        with open(self._path + '.tmp', 'w') as f:
+            json.dump(self._entries, f)
+        os.rename(self._path + '.tmp', self._path)
+
+
+def _make_cache_dir(cache_dir):
+    """Create a cache directory that is ignored by git
+
+    Args:
+        cache_dir (str): the directory the cache is kept in
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+        with open(os.path.join(cache_dir, '.gitignore'), 'w') as f:
+            f.write('*\n')
+
+
+def _discoverable_config_files():
+    """List the config files flake8 would discover on its own
+
+    That is the user config plus the project configs of the working directory or, failing that, of the nearest
+    parent directory that has any.
+
+    Returns:
+        list[str]: the paths of the candidate config files
+    """
+    config_home = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser(os.path.join('~', '.config'))
+    candidates = [os.path.join(config_home, 'flake8')]
+    directory = os.path.abspath(os.getcwd())
+    while True:
+        local = [os.path.join(directory, name) for name in ('setup.cfg', 'tox.ini', '.flake8')]
+        candidates.extend(local)
+        parent = os.path.dirname(directory)
+        if any(os.path.exists(f) for f in local) or parent == directory:
+            return candidates
+        directory = parent
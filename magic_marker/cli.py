@@ -6,33 +6,379 @@
 # ======================================================================================================================
 from __future__ import absolute_import
 from magic_marker.magic_marker import MagicMarker
+from magic_marker.backup import Backup, ArchiveBackup, BackupStore
+from magic_marker.index import MarkIndex
+from magic_marker.report import REPORT_FORMATS
+from magic_marker.timing import profiled
 import sys
+import os
 import click
 
 
 # ======================================================================================================================
 # Main
 # ======================================================================================================================
-@click.command()
+class DefaultGroup(click.Group):
+    """A group that runs the mark command unless another command is named, so 'magic-marker PATH' keeps working"""
+
+    default_command = 'mark'
+
+    def parse_args(self, ctx, args):
+        """Route the arguments to the default command unless they start with the name of a command or ask for help
+
+        A path named like a command runs the command, with a warning, './PATH' marks the path instead.
+
+        Args:
+            ctx (click.Context): the context of the group
+            args (list[str]): the command line arguments
+
+        Returns:
+            list[str]: the arguments left to parse
+        """
+        if args and args[0] in self.commands and os.path.exists(args[0]):
+            click.echo("Magic Marker runs the '{0}' command, pass './{0}' to mark the path".format(args[0]), err=True)
+        elif not args or (args[0] not in self.commands and args[0] not in ctx.help_option_names):
+            args = [self.default_command] + list(args)
+        return super(DefaultGroup, self).parse_args(ctx, args)
+
+
+@click.group(cls=DefaultGroup, context_settings={'help_option_names': ['-h', '--help']})
+def main():
+    """Automatically fix tests that are not marked with a UUID.
+
+    'magic-marker PATH' runs the mark command, see 'magic-marker mark --help' for its options.
+    """
+    pass
+
+
+@main.command('mark')
 @click.option('--config',
               is_flag=False,
               default=None,
               help='Path to the config file that will be the authoritative config source.')
+@click.option('--engine',
+              type=click.Choice(MagicMarker.engines),
+              default='flake8',
+              help='The engine used to find unmarked tests, "ast" parses files directly without running flake8.')
+@click.option('--jobs',
+              type=click.IntRange(min=1),
+              default=None,
+              help='The number of worker processes used to fix files. [default: CPU count]')
+@click.option('--cache',
+              is_flag=True,
+              default=False,
+              help='Skip files that had nothing to fix on a previous run and have not changed since.')
+@click.option('--cache-dir',
+              default='.magic_marker_cache',
+              show_default=True,
+              help='The directory the cache is kept in.')
+@click.option('--changed-since',
+              default=None,
+              metavar='REF',
+              help='Only process the test files added or modified since this git ref.')
+@click.option('--full-backup',
+              is_flag=True,
+              default=False,
+              help='Backup the whole target up front instead of only the files that are about to be rewritten.')
+@click.option('--backup-strategy',
+              type=click.Choice(Backup.strategies),
+              default='copy',
+              show_default=True,
+              help='How files are copied into the backup, "reflink" and "hardlink" fall back to a copy when '
+                   'the filesystem does not support them.')
+@click.option('--backup-format',
+              type=click.Choice(('dir',) + ArchiveBackup.formats + ('store',)),
+              default='dir',
+              show_default=True,
+              help='Write the backup as a directory tree, as a single compressed tar with a manifest or into a '
+                   'content-addressed store shared by every run.')
+@click.option('--backup-store',
+              default=None,
+              help='The directory of the backup store. [default: magic_marker_store in the temp directory]')
+@click.option('--backup-keep-runs',
+              type=click.IntRange(min=1),
+              default=10,
+              show_default=True,
+              help='The number of most recent runs kept in the backup store, or of archive backups kept.')
+@click.option('--backup-max-size',
+              type=click.IntRange(min=0),
+              default=None,
+              help='The number of bytes the backup store or the archive backups may hold, older runs are dropped to '
+                   'make room.')
+@click.option('--check-ids',
+              is_flag=True,
+              default=False,
+              help='Look up the IDs of the target in the index, so new IDs never collide with them, and report '
+                   'duplicated IDs.')
+@click.option('--fix-duplicate-ids',
+              is_flag=True,
+              default=False,
+              help='Give every duplicated ID but the first a new value, implies --check-ids.')
+@click.option('--index',
+              is_flag=True,
+              default=False,
+              help='Keep an index of the tests in the cache directory and skip the files it knows are fully marked.')
+@click.option('--watch',
+              is_flag=True,
+              default=False,
+              help='Keep running and mark the tests of files as they are saved, until interrupted.')
+@click.option('--check',
+              is_flag=True,
+              default=False,
+              help='Write nothing and exit with 1 when tests are missing marks, no backup is made.')
+@click.option('--diff',
+              is_flag=True,
+              default=False,
+              help='Write nothing and print the marks that would be added as a unified diff, no backup is made.')
+@click.option('--report',
+              type=click.Path(dir_okay=False, writable=True, allow_dash=True),
+              default=None,
+              help='Write a report of the marks added, the violations left alone and the backup, - for stdout '
+                   'and every other message to stderr.')
+@click.option('--report-format',
+              type=click.Choice(REPORT_FORMATS),
+              default='json',
+              show_default=True,
+              help='Write the report as a single JSON document or as JSON Lines, a record per line.')
+@click.option('--timings',
+              is_flag=True,
+              default=False,
+              help='Print where the time went, per phase, with counts and the time spent fixing each file.')
+@click.option('--profile',
+              type=click.Path(dir_okay=False, writable=True),
+              default=None,
+              help='Run under cProfile and save the statistics to this file, implies --timings.')
 @click.argument('test_path', type=click.Path(exists=True))
-def main(test_path, config):
+def mark(test_path, config, engine, jobs, cache, cache_dir, changed_since, full_backup, backup_strategy,
+         backup_format, backup_store, backup_keep_runs, backup_max_size, check_ids, fix_duplicate_ids, index,
+         watch, check, diff, report, report_format, timings, profile):
     """Automatically fix tests that are not marked with a UUID.
 
+    This is the default command, 'magic-marker PATH' is 'magic-marker mark PATH'. Pass './PATH' to mark a path named
+    like one of the other commands.
+
     \b
     Required Arguments:
         test_path               the path to pass to flake8
+
+    \b
+    Other Commands:
+        index                   query the marks of a tree
+        pre-commit              mark the files passed by a pre-commit hook
+        serve                   answer the requests of editors and git hooks
+    See 'magic-marker COMMAND --help' for the options of each.
+    """
+
+    if watch and changed_since:
+        raise click.UsageError("--watch only marks the files being saved, it can not be combined with --changed-since")
+    if watch and (check or diff):
+        raise click.UsageError("--watch writes the files being saved, it can not be combined with --check or --diff")
+    if watch and (report or timings or profile):
+        raise click.UsageError("--report, --timings and --profile describe a single run, "
+                               "they can not be combined with --watch")
+    if diff and report == '-':
+        raise click.UsageError("--diff already writes to stdout, --report needs a file")
+    err = report == '-'  # stdout only holds the report
+    try:
+        mm = MagicMarker(engine=engine,
+                         jobs=jobs,
+                         cache_dir=cache_dir if cache else None,
+                         full_backup=full_backup,
+                         backup_strategy=backup_strategy,
+                         backup_format=backup_format,
+                         backup_store=BackupStore(backup_store, backup_keep_runs, backup_max_size),
+                         check_ids=check_ids,
+                         fix_duplicate_ids=fix_duplicate_ids,
+                         index_dir=cache_dir if index else None,
+                         dry_run=check or diff,
+                         backup_keep_runs=backup_keep_runs,
+                         backup_max_size=backup_max_size)
+        if watch:
+            click.echo(click.style("Watching {} for changes, press Ctrl+C to stop".format(test_path), fg='green'))
+            try:
+                mm.watch(test_path, config, lambda message: _echo_run(mm, message))
+            except KeyboardInterrupt:
+                click.echo(click.style("\nStopped watching", fg='green'))
+            return
+        with profiled(profile):
+            message = mm.run_flake8_and_mark(test_path, config, changed_since=changed_since)
+        if timings or profile:
+            click.echo(mm.timings.table(), err=True)
+        if report:
+            with click.open_file(report, 'w') as f:
+                mm.report.write(f, report_format)
+        if check or diff:
+            _echo_dry_run(mm, message, diff)
+            sys.exit(1 if check and mm.diff else 0)
+        click.echo(click.style("\nSuccess!", fg='green'), err=err)
+        _echo_run(mm, message, err)
+    except RuntimeError as e:
+        click.echo(click.style(str(e), fg='red'), err=err)
+        click.echo(click.style("\nFailed!", fg='red'), err=err)
+
+        sys.exit(1)
+
+
+def _echo_run(mm, message, err=False):
+    """Report the backup and the fixes of a run
+
+    Args:
+        mm (MagicMarker): the MagicMarker that performed the run
+        message (str): the message stating what was performed
+        err (bool): report to stderr instead of stdout
+    """
+    if os.path.exists(mm.backup_path):
+        click.echo(click.style("\nA backup was created : {}".format(mm.backup_path), fg='green'), err=err)
+    else:
+        click.echo(click.style("\nNo files were rewritten, no backup was necessary", fg='green'), err=err)
+    click.echo(click.style(message, fg='green'), err=err)
+
+
+def _echo_dry_run(mm, message, diff):
+    """Report the fixes a dry run worked out, the diff goes to stdout and everything else to stderr
+
+    Args:
+        mm (MagicMarker): the MagicMarker that performed the dry run
+        message (str): the message stating what would be performed
+        diff (bool): whether to print the diff
+    """
+    if diff:
+        click.echo(mm.diff, nl=False)
+    if mm.diff:
+        click.echo(click.style(message.lstrip('\n'), fg='yellow'), err=True)
+    else:
+        click.echo(click.style("Every test is marked", fg='green'), err=True)
+
+
+@main.command('index')
+@click.option('--config',
+              is_flag=False,
+              default=None,
+              help='Path to the config file that will be the authoritative config source.')
+@click.option('--cache-dir',
+              default='.magic_marker_cache',
+              show_default=True,
+              help='The directory the index is kept in.')
+@click.option('--no-update',
+              is_flag=True,
+              default=False,
+              help='Answer from the index as it is, without looking for changed files first.')
+@click.option('--find',
+              'values',
+              multiple=True,
+              metavar='VALUE',
+              help='List the tests carrying a mark with this value, ex: a UUID. May be repeated.')
+@click.option('--unmarked',
+              is_flag=True,
+              default=False,
+              help='Count the tests under the path that are missing a mark.')
+@click.argument('test_path', type=click.Path(exists=True))
+def index(test_path, config, cache_dir, no_update, values, unmarked):
+    """Index the tests under a path and the values of their marks.
+
+    Files are only parsed again when their content changed since they were last indexed.
+
+    \b
+    Required Arguments:
+        test_path               the path to index
+    """
+
+    try:
+        mm = MagicMarker(cache_dir=cache_dir)
+        mm.find_options(config)
+        mark_index = MarkIndex(cache_dir, mm.options, mm.file_finder)
+        try:
+            if not no_update:
+                indexed, updated = mark_index.update(test_path)
+                click.echo("{} files indexed, {} of them updated".format(indexed, updated))
+            for value in values:
+                found = mark_index.find(value)
+                for path, name, line, mark_name in found:
+                    click.echo("{}:{} {} ({})".format(path, line, name, mark_name))
+                if not found:
+                    click.echo("No test carries the value {}".format(value))
+            if unmarked:
+                click.echo("{} unmarked tests under {}".format(mark_index.unmarked(test_path), test_path))
+        finally:
+            mark_index.close()
+    except RuntimeError as e:
+        click.echo(click.style(str(e), fg='red'))
+        click.echo(click.style("\nFailed!", fg='red'))
+
+        sys.exit(1)
+
+
+@main.command('pre-commit')
+@click.option('--config',
+              is_flag=False,
+              default=None,
+              help='Path to the config file that will be the authoritative config source.')
+@click.option('--engine',
+              type=click.Choice(MagicMarker.engines),
+              default='flake8',
+              help='The engine used to find unmarked tests, "ast" parses files directly without running flake8.')
+@click.argument('filenames', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+def pre_commit(filenames, config, engine):
+    """Mark the tests of the files passed by a pre-commit hook, failing when any file was changed.
+
+    Only the python files given are checked and only the files that are rewritten are backed up, so the time taken
+    depends on the number of files staged rather than on the size of the repository.
+
+    \b
+    Optional Arguments:
+        filenames               the files to check
+    """
+
+    filenames = [os.path.abspath(f) for f in filenames if f.endswith('.py')]
+    if not filenames:
+        return
+    root = os.path.dirname(os.path.commonprefix(filenames))
+    try:
+        mm = MagicMarker(engine=engine, jobs=1)
+        message = mm.run_flake8_and_mark(root, config, files=filenames)
+    except RuntimeError as e:
+        click.echo(click.style(str(e), fg='red'))
+        click.echo(click.style("\nFailed!", fg='red'))
+
+        sys.exit(1)
+    if os.path.exists(mm.backup_path):
+        _echo_run(mm, message)
+        sys.exit(1)  # pre-commit only fails a hook that changed files through its exit code
+
+
+@main.command('serve')
+@click.option('--config',
+              is_flag=False,
+              default=None,
+              help='Path to the config file that will be the authoritative config source.')
+@click.option('--engine',
+              type=click.Choice(MagicMarker.engines),
+              default='flake8',
+              help='The engine used to find unmarked tests in files, source buffers are always parsed directly.')
+@click.option('--socket',
+              'socket_path',
+              default=os.path.join('.magic_marker_cache', 'server.sock'),
+              show_default=True,
+              help='The Unix socket to listen on.')
+@click.argument('root', default='.', type=click.Path(exists=True, file_okay=False))
+def serve(root, config, engine, socket_path):
+    """Answer the requests of editors and git hooks, see magic-marker-client.
+
+    The configuration and flake8 are loaded once and kept in memory, so marking a few files does not pay for them
+    again. Requires python 3.5 or later.
+
+    \b
+    Optional Arguments:
+        root                    the directory holding the files that may be marked
     """
 
     try:
-        mm = MagicMarker()
-        message = mm.run_flake8_and_mark(test_path, config)
-        click.echo(click.style("\nSuccess!", fg='green'))
-        click.echo(click.style("\nA backup was created : {}".format(mm.backup_path), fg='green'))
-        click.echo(click.style(message, fg='green'))
+        if sys.version_info < (3, 5):
+            raise RuntimeError("Magic Marker needs python 3.5 or later to serve")
+        from magic_marker.server import MarkServer
+        server = MarkServer(MagicMarker(engine=engine, jobs=1), config, socket_path, root)
+        click.echo(click.style("Serving {} on {}, press Ctrl+C to stop".format(root, socket_path), fg='green'))
+        server.serve_forever()
     except RuntimeError as e:
         click.echo(click.style(str(e), fg='red'))
         click.echo(click.style("\nFailed!", fg='red'))
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""A thin client of 'magic-marker serve', for editors and git hooks that can not afford to start flake8
+
+Only the standard library is imported, so a request costs little more than the interpreter start.
+"""
+# ======================================================================================================================
+# Imports
+# ======================================================================================================================
+from __future__ import absolute_import, print_function
+import argparse
+import socket
+import json
+import sys
+import os
+
+# ======================================================================================================================
+# Globals
+# ======================================================================================================================
+DEFAULT_SOCKET = os.path.join('.magic_marker_cache', 'server.sock')
+
+
+def request(socket_path, payload):
+    """Send a request to the server and wait for the response
+
+    Args:
+        socket_path (str): the path of the Unix socket of the server
+        payload (dict): the request
+
+    Returns:
+        dict: the response
+
+    Raises:
+        RuntimeError: the server could not be reached
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall(json.dumps(payload).encode('utf-8') + b'\n')
+        response = b''
+        while not response.endswith(b'\n'):
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            response += chunk
+    except (IOError, OSError):
+        raise RuntimeError("Magic Marker was not able to reach a server on {}".format(socket_path))
+    finally:
+        client.close()
+    try:
+        return json.loads(response.decode('utf-8'))
+    except ValueError:
+        raise RuntimeError("Magic Marker did not understand the response of the server on {}".format(socket_path))
+
+
+def main(argv=None):
+    """Console script for the magic-marker server client
+
+    Args:
+        argv (list[str]): the command line arguments, defaults to sys.argv
+
+    Returns:
+        int: the exit code
+    """
+    parser = argparse.ArgumentParser(prog='magic-marker-client', description=__doc__.splitlines()[0])
+    parser.add_argument('--socket',
+                        default=DEFAULT_SOCKET,
+                        help='The Unix socket of the server. [default: %(default)s]')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('status', help='Describe the server.')
+    mark = commands.add_parser('mark', help='Mark the tests of files.')
+    mark.add_argument('files', nargs='+')
+    source = commands.add_parser('mark-source', help='Print the source of a file with its tests marked, '
+                                                     'without changing the file. Use - to read standard input.')
+    source.add_argument('file')
+    args = parser.parse_args(argv)
+
+    if args.command == 'status':
+        payload = {'command': 'status'}
+    elif args.command == 'mark':
+        payload = {'command': 'mark', 'files': [os.path.abspath(f) for f in args.files]}
+    elif args.command == 'mark-source':
+        if args.file == '-':
+            payload = {'command': 'mark_source', 'source': sys.stdin.read()}
+        else:
+            with open(args.file, 'r') as f:
+                payload = {'command': 'mark_source', 'source': f.read(), 'filename': os.path.abspath(args.file)}
+    else:
+        parser.error('a command is required')
+
+    try:
+        response = request(args.socket, payload)
+    except RuntimeError as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    if not response.get('ok'):
+        print(response.get('error'), file=sys.stderr)
+        return 1
+    if args.command == 'mark-source':
+        sys.stdout.write(response['source'])
+    elif args.command == 'mark':
+        print(response['message'] or 'No test marks added')
+        if response['backup']:
+            print('A backup was created : {}'.format(response['backup']))
+    else:
+        print(json.dumps(response, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())  # pragma: no cover
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+
+"""A native detector for unmarked tests that does not need a flake8 round-trip"""
+# ======================================================================================================================
+# Imports
+# ======================================================================================================================
+from __future__ import absolute_import
+import fnmatch
+import ast
+import os
+import re
+
+# ======================================================================================================================
+# Globals
+# ======================================================================================================================
+DEFAULT_EXCLUDE = ('.svn', 'CVS', '.bzr', '.hg', '.git', '__pycache__', '.tox', '.eggs', '*.egg')  # flake8's defaults
+DEFAULT_FILENAME = ('*.py',)  # flake8's default for its filename option
+
+
+class FileFinder(object):
+    """Finds the files flake8 checks under a path, following its exclude, extend-exclude and filename options
+
+    An exclude pattern matches the name of a file or directory or, as flake8 makes any pattern holding a path
+    separator absolute, its absolute path. A filename pattern matches the path of a file as it is found.
+    """
+
+    def __init__(self, exclude=DEFAULT_EXCLUDE, filename=DEFAULT_FILENAME):
+        """Create a new FileFinder object
+
+        Args:
+            exclude (list[str]): the patterns of the files and directories to skip
+            filename (list[str]): the patterns of the files to check
+        """
+        self.exclude = list(exclude)
+        self.filename = list(filename)
+
+    @classmethod
+    def from_flake8(cls, options):
+        """Read the file options of a loaded flake8 configuration
+
+        Args:
+            options (optparse.Values): the flake8 options
+
+        Returns:
+            FileFinder
+        """
+        exclude = list(options.exclude or ()) + list(getattr(options, 'extend_exclude', None) or ())  # flake8 >= 3.8
+        return cls(exclude, options.filename or DEFAULT_FILENAME)
+
+    def to_dict(self):
+        """The options as plain data, FileFinder(**data) creates the same finder
+
+        Returns:
+            dict
+        """
+        return {'exclude': self.exclude, 'filename': self.filename}
+
+    def is_excluded(self, path):
+        """Check whether a file or directory is excluded
+
+        Args:
+            path (str): the path of the file or directory
+
+        Returns:
+            bool
+        """
+        return _fnmatch(os.path.basename(path), self.exclude) or _fnmatch(os.path.abspath(path), self.exclude)
+
+    def iter_files(self, path):
+        """Find the files under a path, a file given as the path is only skipped when it is excluded
+
+        Args:
+            path (str): a file or directory
+
+        Yields:
+            str: the path of a file
+        """
+        if self.is_excluded(path):
+            return
+        if not os.path.isdir(path):
+            yield path
+            return
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not self.is_excluded(os.path.join(root, d)))
+            for name in sorted(files):
+                filename = os.path.join(root, name)
+                if _fnmatch(filename, self.filename) and not self.is_excluded(filename):
+                    yield filename
+
+    def includes(self, filename, path):
+        """Check whether a file is one of the files found under a path, without walking the tree
+
+        Args:
+            filename (str): the path of the file
+            path (str): a file or directory
+
+        Returns:
+            bool
+        """
+        if not os.path.isdir(path):
+            return os.path.abspath(filename) == os.path.abspath(path) and not self.is_excluded(path)
+        relative = os.path.relpath(os.path.abspath(filename), os.path.abspath(path))
+        if relative == os.curdir or relative.split(os.sep)[0] == os.pardir or self.is_excluded(path):
+            return False
+        for part in relative.split(os.sep):
+            path = os.path.join(path, part)
+            if self.is_excluded(path):
+                return False
+        return _fnmatch(path, self.filename)
+
+
+def missing_mark_code(rule_name):
+    """Generate the code flake8-pytest-mark reports for a test missing the mark of a mark config name
+
+    Args:
+        rule_name (str): the mark config name ex: 'pytest_mark3'
+
+    Returns:
+        str: the code ex: 'M503'
+    """
+    return 'M5{}'.format(''.join(c for c in rule_name if c.isdigit()).zfill(2))
+
+
+class AstDetector(object):
+    """Find tests that are missing a configured pytest mark by walking the AST of each file
+
+    The records produced mirror the M5xx violations of flake8-pytest-mark as rendered by flake8-json
+    """
+
+    test_def_regex = re.compile(r'^(test_)|(Test)')
+
+    def __init__(self, mark_configuration, file_finder=None):
+        """Create a new AstDetector object
+
+        Args:
+            mark_configuration (dict): mark config name (key), dict (value) as found by MagicMarker.find_options
+            file_finder (FileFinder): picks the files to check as flake8 would, defaults to flake8's defaults
+        """
+        self._mark_configuration = mark_configuration or {}
+        self._file_finder = file_finder or FileFinder()
+
+    def detect(self, path):
+        """Detect unmarked tests under a path
+
+        Args:
+            path (str): a file or directory to inspect
+
+        Returns:
+            dict: filename (key), list of violation records (value) in the same shape as flake8-json output
+        """
+        output = {}
+        for filename in self.iter_files(path):
+            output[filename] = self.check_file(filename)
+        return output
+
+    def iter_files(self, path):
+        """Find the files flake8 would check under a path
+
+        Args:
+            path (str): a file or directory
+
+        Returns:
+            generator: the paths of the files
+        """
+        return self._file_finder.iter_files(path)
+
+    def check_file(self, filename):
+        """Check a single file for unmarked tests
+
+        Args:
+            filename (str): the path of the file to check
+
+        Returns:
+            list[dict]: the violation records for the file
+        """
+        with open(filename, 'r') as f:
+            source = f.read()
+        return self.check_source(source, filename)
+
+    def check_source(self, source, filename):
+        """Check python source for unmarked tests
+
+        Args:
+            source (str): the python source to check
+            filename (str): the name to report the violations against
+
+        Returns:
+            list[dict]: the violation records for the source
+        """
+        try:
+            tree = ast.parse(source, filename)
+        except SyntaxError:
+            return []  # flake8 reports E999 and never runs the mark checks on such a file
+        return self.check_tree(tree, filename)
+
+    def check_tree(self, tree, filename):
+        """Check a parsed module for unmarked tests
+
+        Args:
+            tree (ast.Module): the module to check
+            filename (str): the name to report the violations against
+
+        Returns:
+            list[dict]: the violation records for the module
+        """
+        records = []
+        for node in ast.walk(tree):
+            if type(node) in (ast.FunctionDef, ast.ClassDef) and self.test_def_regex.match(node.name):
+                for rule_name, rule_conf in self._mark_configuration.items():
+                    if not self._should_process(rule_conf, node):
+                        continue
+                    if not self._has_mark(node.decorator_list, rule_conf['name']):
+                        records.append(self._record(filename, node, rule_name, rule_conf))
+        records.sort(key=lambda x: (x['line_number'], x['code']))
+        return records
+
+    def _record(self, filename, node, rule_name, rule_conf):
+        """Build a violation record
+
+        Args:
+            filename (str): the name of the file the node belongs to
+            node (ast.AST): the test definition that is missing the mark
+            rule_name (str): the mark config name ex: 'pytest_mark1'
+            rule_conf (dict): the mark configuration
+
+        Returns:
+            dict: the violation record
+        """
+        return {'code': missing_mark_code(rule_name),
+                'filename': filename,
+                'line_number': node.lineno,  # the line flake8-pytest-mark reports, whatever the interpreter
+                'column_number': 1,
+                'text': 'test definition not marked with {}'.format(rule_conf['name'])}
+
+    @staticmethod
+    def _has_mark(decorators, mark):
+        """Check whether any decorator is the named pytest mark
+
+        Args:
+            decorators (list): the decorator nodes of a definition
+            mark (str): the name of the mark
+
+        Returns:
+            bool
+        """
+        for decorator in decorators:
+            if isinstance(decorator, ast.Call):
+                try:
+                    if decorator.func.attr == mark and decorator.func.value.value.id == 'pytest':
+                        return True
+                except AttributeError:
+                    pass
+            elif isinstance(decorator, ast.Attribute) and decorator.attr == mark:
+                return True
+        return False
+
+    @classmethod
+    def _should_process(cls, rule_conf, node):
+        """Evaluate whether a definition is covered by a mark configuration
+
+        Args:
+            rule_conf (dict): the mark configuration
+            node (ast.AST): the definition under evaluation
+
+        Returns:
+            bool
+        """
+        if type(node) == ast.ClassDef:
+            return not cls._is_true('exclude_classes', rule_conf)
+        if cls._is_method(node):
+            return not cls._is_true('exclude_methods', rule_conf)
+        return not cls._is_true('exclude_functions', rule_conf)
+
+    @staticmethod
+    def _is_method(node):
+        """Test if a function definition is a method
+
+        Args:
+            node (ast.FunctionDef): the definition under evaluation
+
+        Returns:
+            bool
+        """
+        if not node.args.args:
+            return False
+        first = node.args.args[0]
+        return getattr(first, 'id', getattr(first, 'arg', '')) in ('self', 'cls')
+
+    @staticmethod
+    def _is_true(key, rule_conf):
+        """Read a boolean option from a mark configuration, defaulting to false
+
+        Args:
+            key (str): the option name
+            rule_conf (dict): the mark configuration
+
+        Returns:
+            bool
+        """
+        return rule_conf.get(key, '').strip().lower() == 'true'
+
+
+def _fnmatch(name, patterns):
+    """Match a name against patterns, as flake8 does
+
+    Args:
+        name (str): the name or path
+        patterns (list[str]): the patterns
+
+    Returns:
+        bool
+    """
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
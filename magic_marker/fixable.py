@@ -4,16 +4,44 @@
 # Imports
 # ======================================================================================================================
 from __future__ import absolute_import
-from magic_marker.fixes import Fixes
+from magic_marker.fixes import FixStrategy, UuidFix, EmptyValueFix
+from magic_marker.detector import missing_mark_code
+
+# ======================================================================================================================
+# Globals
+# ======================================================================================================================
+ENTRY_POINT_GROUP = 'magic_marker.fixes'
+_plugins = {}  # fix name (key), FixStrategy or None when no plug-in provides it (value), for the life of the process
 
 
 class Fixable(object):
     """A class to tell if a mark is fixable
+
+    The mark configuration is compiled into a table from error code to mark name and fix, so telling whether a
+    violation is fixable costs a single lookup. Fixes other than the built in ones come from the plug-ins of the
+    'magic_marker.fixes' entry-point group, a plug-in is only imported once a mark refers to it.
+
+    A mark with neither a 'fix' option nor a 'value_match' naming a fix gets the fix its name has in default_fixes.
     """
 
+    fixes = {'uuid': UuidFix(), 'empty_value': EmptyValueFix()}
+    default_fixes = {'test_case_with_steps': 'empty_value'}  # mark name (key), fix name (value), as it always was
+
     def __init__(self):
         """Create a fixable object"""
-        self._fix_functions = (self._uuid, self._empty_value)
+        self._mark_configuration = None
+        self._table = {}
+
+    def __getstate__(self):
+        """Drop the compiled table so a Fixable can be sent to a worker process, it is compiled again on first use
+
+        Returns:
+            dict: the picklable state
+        """
+        state = self.__dict__.copy()
+        state['_mark_configuration'] = None
+        state['_table'] = {}
+        return state
 
     def check(self, flake8_out_line, mark_configuration):
         """Check if a mark is fixable by any of the functions known
@@ -23,58 +51,137 @@ class Fixable(object):
             mark_configuration (dict): mark name (key), dict (value)
 
         Returns:
-            tuple: (str, bound method)
+            tuple: (str, FixStrategy)
             tuple: (None, None)
         """
-        for func in self._fix_functions:
-            f = func(flake8_out_line, mark_configuration)
-            if f:
-                return f
-        return None, None
+        if mark_configuration is not self._mark_configuration:
+            self.load(mark_configuration)
+        return self._table.get(flake8_out_line['code'], (None, None))
 
-    def _pull_mark_config_name_from_output(self, out_line):
-        """generates the pytest mark instance name from the flake8 error code
+    def load(self, mark_configuration):
+        """Compile the table for a mark configuration
 
         Args:
-            out_line (dict): details of output from flake8
+            mark_configuration (dict): mark name (key), dict (value)
 
-        Returns:
-            str: the pytest mark instance name ex: 'pytest_mark2'
+        Raises:
+            RuntimeError: a mark asks for a fix that is not known
         """
-        return 'pytest_mark{}'.format(int(out_line['code'][-2:]))
+        self._table = self.compile(mark_configuration)
+        self._mark_configuration = mark_configuration
 
-    def _uuid(self, flake8_out_line, mark_configuration):
-        """Check if a mark is fixable by the UUID schema
-        If it is fixable supply fixing method
+    @classmethod
+    def compile(cls, mark_configuration):
+        """Build the table of the fixable marks
 
         Args:
-            flake8_out_line (dict): details of output from flake8
             mark_configuration (dict): mark name (key), dict (value)
 
         Returns:
-            tuple: (str, bound method)
+            dict: error code (key), tuple of the mark name and the fix (value)
+
+        Raises:
+            RuntimeError: a mark asks for a fix that is not known
         """
-        try:
-            name = mark_configuration[self._pull_mark_config_name_from_output(flake8_out_line)]['name']
-            if mark_configuration[self._pull_mark_config_name_from_output(flake8_out_line)]['value_match'] == 'uuid':
-                return name, Fixes.uuid  # not sure if this will work or not
-        except KeyError:
-            pass
+        table = {}
+        for config_name, rule_conf in (mark_configuration or {}).items():
+            if 'name' not in rule_conf:
+                continue
+            fix = cls._fix(config_name, rule_conf)
+            if fix is None and 'fix' not in rule_conf and rule_conf['name'] in cls.default_fixes:
+                fix = cls.fixes[cls.default_fixes[rule_conf['name']]]
+            if fix is not None:
+                table[missing_mark_code(config_name)] = (rule_conf['name'], fix)
+        return table
+
+    @classmethod
+    def _fix(cls, config_name, rule_conf):
+        """Pick the fix of a mark
+
+        The 'fix' option names the fix, otherwise the 'value_match' option does when a fix of that name exists, see
+        Fixable.default_fixes for the marks with neither. 'fix=none' leaves the mark alone.
 
-    def _empty_value(self, flake8_out_line, mark_configuration):
-        """Check if a mark is fixable by the empty_value schema
-        If it is fixable supply fixing method
+        Args:
+            config_name (str): the mark config name ex: 'pytest_mark1'
+            rule_conf (dict): the mark configuration
+
+        Returns:
+            FixStrategy: the fix or None
+
+        Raises:
+            RuntimeError: the 'fix' option names a fix that is not known
+        """
+        if 'fix' in rule_conf:
+            name = rule_conf['fix'].strip()
+            if name == 'none':
+                return None
+            fix = cls._lookup(name)
+            if fix is None:
+                raise RuntimeError("Magic Marker does not know the fix '{}' of {}".format(name, config_name))
+            return fix
+        if 'value_match' in rule_conf:
+            fix = cls._lookup(rule_conf['value_match'].strip())
+            if fix is not None:
+                return fix
+        return None
+
+    @classmethod
+    def _lookup(cls, name):
+        """Find a fix by name, among the built in fixes and then the plug-ins
 
         Args:
-            flake8_out_line (dict): details of output from flake8
-            mark_configuration (dict): mark name (key), dict (value)
+            name (str): the name of the fix
 
         Returns:
-            tuple: (str, bound method)
+            FixStrategy: the fix or None
         """
+        if name in cls.fixes:
+            return cls.fixes[name]
+        if name not in _plugins:
+            _plugins[name] = _load_plugin(name)
+        return _plugins[name]
+
+
+def _load_plugin(name):
+    """Import the fix registered under a name in the 'magic_marker.fixes' entry-point group
+
+    Args:
+        name (str): the name of the entry point
+
+    Returns:
+        FixStrategy: the fix or None if no plug-in provides it
+
+    Raises:
+        RuntimeError: the plug-in could not be loaded or is not a FixStrategy
+    """
+    for entry_point in _iter_entry_points(name):
         try:
-            name = mark_configuration[self._pull_mark_config_name_from_output(flake8_out_line)]['name']
-            if name == 'test_case_with_steps':  # hard code this hack until this can be configured
-                return name, Fixes.empty_value  # not sure if this will work or not
-        except KeyError:
-            pass
+            fix = entry_point.load()
+        except Exception:  # a broken plug-in can fail in any way
+            raise RuntimeError("Magic Marker was not able to load the fix plug-in '{}'".format(name))
+        if isinstance(fix, type):
+            fix = fix()
+        if not isinstance(fix, FixStrategy):
+            raise RuntimeError("Magic Marker fix plug-in '{}' is not a FixStrategy".format(name))
+        return fix
+    return None
+
+
+def _iter_entry_points(name):
+    """List the entry points registered under a name in the 'magic_marker.fixes' group, without importing them
+
+    Args:
+        name (str): the name of the entry point
+
+    Returns:
+        list: the entry points
+    """
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:  # python < 3.8
+        import pkg_resources
+        return list(pkg_resources.iter_entry_points(ENTRY_POINT_GROUP, name))
+    found = entry_points()
+    if hasattr(found, 'select'):
+        return list(found.select(group=ENTRY_POINT_GROUP, name=name))
+    return [entry_point for entry_point in found.get(ENTRY_POINT_GROUP, ()) if entry_point.name == name]
@@ -7,20 +7,77 @@ from __future__ import absolute_import
 import uuid
 
 
+class FixStrategy(object):
+    """A way of generating a missing mark, the base of the strategies of the 'magic_marker.fixes' entry-point group
+
+    The values of the marks added to a file are generated together, in a single call to FixStrategy.values
+    """
+
+    def values(self, mark_name, count):
+        """Generate the values of a batch of marks
+
+        Args:
+            mark_name (str): the name of the marks to add
+            count (int): the number of values needed
+
+        Returns:
+            list[str]: the values, None for a mark without arguments
+        """
+        return [None] * count
+
+    def __call__(self, mark_name, value=None):
+        """Generate a mark
+
+        Args:
+            mark_name (str): the name of the mark to add
+            value (str): the value of the mark, a single value is generated if None
+
+        Returns:
+            str: the complete pytest mark to be added
+        """
+        if value is None:
+            value = self.values(mark_name, 1)[0]
+        if value is None:
+            return "@pytest.mark.{}()\n".format(mark_name)
+        return "@pytest.mark.{}('{}')\n".format(mark_name, value)
+
+
+class UuidFix(FixStrategy):
+    """Marks with a UUID"""
+
+    def values(self, mark_name, count):
+        """Generate a batch of UUIDs
+
+        Args:
+            mark_name (str): the name of the marks to add
+            count (int): the number of values needed
+
+        Returns:
+            list[str]: the UUIDs
+        """
+        return [str(uuid.uuid1()) for _ in range(count)]
+
+
+class EmptyValueFix(FixStrategy):
+    """Marks without arguments"""
+    pass
+
+
 class Fixes(object):
     """A class containing fixes"""
 
     @classmethod
-    def uuid(cls, mark_name):
+    def uuid(cls, mark_name, value=None):
         """The fix for a mark with a UUID
 
         Args:
             mark_name (str): the name of the mark to add
+            value (str): an ID minted ahead of time, a new UUID is generated if None
 
         Returns:
             str: the complete pytest mark to be added
         """
-        return "@pytest.mark.{}('{}')\n".format(mark_name, str(uuid.uuid1()))
+        return UuidFix()(mark_name, value)
 
     @classmethod
     def empty_value(cls, mark_name):
@@ -32,4 +89,4 @@ class Fixes(object):
         Returns:
             str: the complete pytest mark to be added
         """
-        return "@pytest.mark.{}()\n".format(mark_name)
+        return EmptyValueFix()(mark_name)
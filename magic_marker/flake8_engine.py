@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""Drive flake8 programmatically, without patching sys.argv or sys.stdout"""
+# ======================================================================================================================
+# Imports
+# ======================================================================================================================
+from __future__ import absolute_import
+from flake8.main.application import Application
+from flake8.formatting.base import BaseFormatter
+from magic_marker.detector import FileFinder
+import re
+
+
+class Flake8Engine(object):
+    """A single flake8 Application used both to read the mark configuration and to run the M5 checks"""
+
+    def __init__(self, config):
+        """Create a new Flake8Engine object, loading the plug-ins and the configuration once
+
+        Args:
+            config (str): The path to a config to be passed to flake8
+        """
+        args = ["--select=M5"]  # only covers case of no mark present
+        if config:
+            args.append("--config={}".format(config))
+        self._app = Application()
+        self._app.initialize(args)
+
+    def mark_configuration(self):
+        """Read the pytest_mark options of the loaded configuration
+
+        Returns:
+            dict: mark config name (key), dict (value)
+        """
+        opts = {}
+        for key, value in list(vars(self._app.options).items()):
+            if re.match(r'pytest_mark.*', key):
+                for option in value:
+                    try:
+                        opts[key]
+                    except KeyError:
+                        opts[key] = {}
+                    val = option.split('=')
+                    opts[key][val[0]] = val[1]
+        return opts
+
+    def file_finder(self):
+        """Read the options telling which files flake8 checks
+
+        Returns:
+            FileFinder
+        """
+        return FileFinder.from_flake8(self._app.options)
+
+    def check(self, paths, on_file):
+        """Run the checks, handing the violations of each file over as soon as flake8 reports them
+
+        Args:
+            paths (list[str]): the files and directories to check
+            on_file (callable): called with (filename, list[dict]) for each file reported by flake8
+        """
+        app = self._app
+        app.formatter = ViolationCollector(app.options, on_file)
+        app.guide = None
+        app.make_guide()
+        app.file_checker_manager = None
+        app.make_file_checker_manager()
+        app.run_checks(list(paths))
+        app.report_errors()
+
+
+class ViolationCollector(BaseFormatter):
+    """A flake8 formatter that hands violations over as records in the shape of flake8-json, without formatting"""
+
+    def __init__(self, options, on_file):
+        """Create a new ViolationCollector object
+
+        Args:
+            options (optparse.Values): the flake8 options
+            on_file (callable): called with (filename, list[dict]) for each file reported by flake8
+        """
+        super(ViolationCollector, self).__init__(options)
+        self._on_file = on_file
+        self._violations = []
+
+    def start(self):
+        """Nothing is written, so there is no output file to open"""
+        pass
+
+    def stop(self):
+        """Nothing is written, so there is no output file to close"""
+        pass
+
+    def beginning(self, filename):
+        """Start collecting the violations of a file
+
+        Args:
+            filename (str): the name of the file
+        """
+        self._violations = []
+
+    def finished(self, filename):
+        """Hand over the violations of a file
+
+        Args:
+            filename (str): the name of the file
+        """
+        violations, self._violations = self._violations, []
+        self._on_file(filename, violations)
+
+    def handle(self, error):
+        """Collect a violation
+
+        Args:
+            error (flake8.style_guide.Violation): the violation
+        """
+        self._violations.append({'code': error.code,
+                                 'filename': error.filename,
+                                 'line_number': error.line_number,
+                                 'column_number': error.column_number,
+                                 'text': error.text,
+                                 'physical_line': error.physical_line})
+
+    def format(self, error):
+        """Violations are never formatted"""
+        return None
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""A registry of the test IDs in a tree, used to mint IDs that collide with none of them"""
+# ======================================================================================================================
+# Imports
+# ======================================================================================================================
+from __future__ import absolute_import
+import uuid
+
+
+class IdRegistry(object):
+    """The values of the UUID marks of a tree as recorded in a MarkIndex, and the IDs minted since
+
+    No file is read to find the IDs, the index only parses the files that changed since it was last updated.
+    """
+
+    max_attempts = 100
+
+    def __init__(self, index, mark_names):
+        """Create a new IdRegistry object
+
+        Args:
+            index (MarkIndex): the index of the tree, up to date with it
+            mark_names (list[str]): the names of the marks holding IDs ex: ['test_id']
+        """
+        self._index = index
+        self._mark_names = sorted(mark_names)
+        self._minted = set()  # (mark name, value) of the IDs minted, the index does not know of them yet
+
+    def __contains__(self, key):
+        """Check whether an ID is taken
+
+        Args:
+            key (tuple(str, str)): the mark name and the value
+
+        Returns:
+            bool
+        """
+        return key in self._minted or bool(self._index.taken(key[0], [key[1]]))
+
+    def mint(self, mark_name, count):
+        """Generate IDs that are not yet taken, reserving them for the caller
+
+        The IDs are looked up in the index together, one query for every attempt rather than one for every ID.
+
+        Args:
+            mark_name (str): the name of the mark the IDs are for
+            count (int): the number of IDs needed
+
+        Returns:
+            list[str]: the new IDs
+
+        Raises:
+            RuntimeError: no free ID could be generated
+        """
+        ids = []
+        collisions = 0
+        while len(ids) < count:
+            drawn = []
+            for _ in range(count - len(ids)):
+                value = str(uuid.uuid1())
+                if (mark_name, value) not in self._minted and value not in drawn:
+                    drawn.append(value)
+            taken = self._index.taken(mark_name, drawn)
+            collisions += count - len(ids) - len(drawn) + len(taken)
+            if collisions > self.max_attempts:
+                raise RuntimeError("Magic Marker was not able to generate a unique ID for {}".format(mark_name))
+            for value in drawn:
+                if value not in taken:
+                    self._minted.add((mark_name, value))
+                    ids.append(value)
+        return ids
+
+    def duplicates(self, path):
+        """Find the IDs used by more than one test under a path
+
+        Args:
+            path (str): a file or directory
+
+        Returns:
+            list[tuple(str, str, list[tuple(str, int)])]: mark name, value and locations of each duplicated ID
+        """
+        return self._index.duplicates(self._mark_names, path)
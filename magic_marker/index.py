@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+"""A persistent SQLite index of the tests in a tree and the marks they carry"""
+# ======================================================================================================================
+# Imports
+# ======================================================================================================================
+from __future__ import absolute_import
+from magic_marker import __version__
+from magic_marker.cache import FileCache, _make_cache_dir
+from magic_marker.detector import AstDetector, FileFinder
+import ast
+import os
+
+# ======================================================================================================================
+# Globals
+# ======================================================================================================================
+SCHEMA = ('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, sha256 TEXT, mtime REAL, size INTEGER, '
+          'unmarked INTEGER)',
+          'CREATE TABLE IF NOT EXISTS tests (path TEXT, name TEXT, line INTEGER)',
+          'CREATE TABLE IF NOT EXISTS marks (path TEXT, test TEXT, mark TEXT, value TEXT, line INTEGER)',
+          'CREATE INDEX IF NOT EXISTS tests_path ON tests (path)',
+          'CREATE INDEX IF NOT EXISTS marks_path ON marks (path)',
+          'CREATE INDEX IF NOT EXISTS marks_value ON marks (value)')
+
+
+class MarkIndex(object):
+    """Records every test of a tree with its qualified name, line and mark values
+
+    A file is only parsed again when its content changed, and the whole index is rebuilt when the mark configuration
+    changes, as the number of unmarked tests recorded for each file depends on it.
+    """
+
+    index_file = 'index.sqlite'
+    layout = 2  # of the tables, an index of an earlier layout is rebuilt
+    max_variables = 500  # bound to a single statement, SQLite allows 999 by default
+    _under = 'path = ? OR substr(path, 1, ?) = ?'  # the files under a path, see MarkIndex._under_args
+
+    def __init__(self, cache_dir, mark_configuration, file_finder=None):
+        """Create a new MarkIndex object, opening or creating the database
+
+        Args:
+            cache_dir (str): the directory the index is kept in, the index is only kept in memory if None
+            mark_configuration (dict): mark config name (key), dict (value) as found by MagicMarker.find_options
+            file_finder (FileFinder): picks the files to index as flake8 would, defaults to flake8's defaults
+        """
+        import sqlite3  # only needed once an index is actually used
+
+        if cache_dir:
+            _make_cache_dir(cache_dir)
+        self._file_finder = file_finder or FileFinder()
+        self._detector = AstDetector(mark_configuration, self._file_finder)
+        self._db = sqlite3.connect(os.path.join(cache_dir, self.index_file) if cache_dir else ':memory:')
+        fingerprint = '{}:{}:{}'.format(__version__, self.layout, FileCache.fingerprint(mark_configuration or {}))
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'config'").fetchone()
+            if not row or row[0] != fingerprint:
+                for table in ('files', 'tests', 'marks'):
+                    self._db.execute('DROP TABLE IF EXISTS {}'.format(table))
+                self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('config', ?)", (fingerprint,))
+            for statement in SCHEMA:
+                self._db.execute(statement)
+
+    def close(self):
+        """Close the database"""
+        self._db.close()
+
+    def update(self, path):
+        """Bring the index up to date with the files flake8 would check under a path, forgetting any other file
+
+        Args:
+            path (str): a file or directory
+
+        Returns:
+            tuple(int, int): the number of files indexed and how many of them had to be parsed
+        """
+        filenames = [os.path.abspath(f) for f in self._file_finder.iter_files(path)]
+        updated = [f for f in filenames if not self._unchanged(f)]
+        with self._db:
+            for filename in updated:
+                self._index_file(filename)
+            present = set(filenames)
+            for (filename,) in self._db.execute('SELECT path FROM files WHERE {}'.format(self._under),
+                                                self._under_args(path)).fetchall():
+                if filename not in present:
+                    self._forget(filename)
+        return len(filenames), len(updated)
+
+    def refresh(self, filenames):
+        """Index files again after they were rewritten
+
+        Args:
+            filenames (iterable[str]): the paths of the files
+        """
+        with self._db:
+            for filename in filenames:
+                filename = os.path.abspath(filename)
+                if not self._unchanged(filename):
+                    self._index_file(filename)
+
+    def is_fully_marked(self, filename):
+        """Check whether a file is known to have no unmarked tests
+
+        Args:
+            filename (str): the path of the file
+
+        Returns:
+            bool
+        """
+        row = self._db.execute('SELECT unmarked FROM files WHERE path = ?', (os.path.abspath(filename),)).fetchone()
+        return bool(row) and row[0] == 0 and self._unchanged(filename)
+
+    def find(self, value):
+        """Find the tests carrying a mark value
+
+        Args:
+            value (str): the mark value ex: a UUID
+
+        Returns:
+            list[tuple(str, str, int, str)]: path, qualified name, line and mark name of each test
+        """
+        return self._db.execute('SELECT marks.path, marks.test, tests.line, marks.mark FROM marks '
+                                'JOIN tests ON tests.path = marks.path AND tests.name = marks.test '
+                                'WHERE marks.value = ? ORDER BY marks.path, tests.line', (value,)).fetchall()
+
+    def unmarked(self, path):
+        """Count the tests under a path that are missing at least one mark
+
+        Args:
+            path (str): a file or directory
+
+        Returns:
+            int
+        """
+        row = self._db.execute('SELECT SUM(unmarked) FROM files WHERE {}'.format(self._under),
+                               self._under_args(path)).fetchone()
+        return row[0] or 0
+
+    def taken(self, mark_name, values):
+        """Find which values of a mark are already carried by a test
+
+        Args:
+            mark_name (str): the name of the mark ex: 'test_id'
+            values (list[str]): the values to look for
+
+        Returns:
+            set[str]
+        """
+        values = list(values)
+        taken = set()
+        for start in range(0, len(values), self.max_variables):
+            chunk = values[start:start + self.max_variables]
+            taken.update(value for (value,) in self._db.execute(
+                'SELECT value FROM marks WHERE mark = ? AND value IN ({})'.format(', '.join('?' * len(chunk))),
+                [mark_name] + chunk))
+        return taken
+
+    def duplicates(self, mark_names, path):
+        """Find the values of marks carried more than once by the tests under a path
+
+        Args:
+            mark_names (list[str]): the names of the marks holding IDs ex: ['test_id']
+            path (str): a file or directory
+
+        Returns:
+            list[tuple(str, str, list[tuple(str, int)])]: mark name, value and the path and line of each occurrence
+        """
+        if not mark_names:
+            return []
+        rows = self._db.execute(
+            'SELECT marks.mark, marks.value, path, line FROM marks JOIN '
+            "(SELECT mark, value FROM marks WHERE mark IN ({}) AND value != '' AND ({}) "
+            'GROUP BY mark, value HAVING COUNT(*) > 1) AS duplicated '
+            'ON marks.mark = duplicated.mark AND marks.value = duplicated.value WHERE {} '
+            'ORDER BY marks.mark, marks.value, path, line'.format(', '.join('?' * len(mark_names)),
+                                                                  self._under, self._under),
+            list(mark_names) + list(self._under_args(path)) * 2)
+        duplicates = []
+        for mark, value, filename, line in rows:
+            if not duplicates or duplicates[-1][:2] != (mark, value):
+                duplicates.append((mark, value, []))
+            duplicates[-1][2].append((filename, line))
+        return duplicates
+
+    @staticmethod
+    def _under_args(path):
+        """The arguments matching MarkIndex._under to the files under a path
+
+        Args:
+            path (str): a file or directory
+
+        Returns:
+            tuple
+        """
+        path = os.path.abspath(path)
+        prefix = os.path.join(path, '')
+        return path, len(prefix), prefix
+
+    def _unchanged(self, filename):
+        """Check whether a file is unchanged since it was indexed, only hashing it when the mtime moved
+
+        Args:
+            filename (str): the absolute path of the file
+
+        Returns:
+            bool
+        """
+        row = self._db.execute('SELECT sha256, mtime, size FROM files WHERE path = ?',
+                               (os.path.abspath(filename),)).fetchone()
+        if not row:
+            return False
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return False
+        if stat.st_size != row[2]:
+            return False
+        return stat.st_mtime == row[1] or FileCache.file_hash(filename) == row[0]
+
+    def _forget(self, filename):
+        """Drop a file from the index
+
+        Args:
+            filename (str): the absolute path of the file
+        """
+        for table in ('files', 'tests', 'marks'):
+            self._db.execute('DELETE FROM {} WHERE path = ?'.format(table), (filename,))
+
+    def _index_file(self, filename):
+        """Parse a file and record its tests and marks
+
+        Args:
+            filename (str): the absolute path of the file
+        """
+        self._forget(filename)
+        stat = os.stat(filename)
+        with open(filename, 'r') as f:
+            source = f.read()
+        try:
+            tree = ast.parse(source, filename)
+        except SyntaxError:
+            tree = ast.parse('')
+        for name, node in _iter_tests(tree.body, ''):
+            line = min([node.lineno] + [d.lineno for d in node.decorator_list])
+            self._db.execute('INSERT INTO tests (path, name, line) VALUES (?, ?, ?)', (filename, name, line))
+            self._db.executemany('INSERT INTO marks (path, test, mark, value, line) VALUES (?, ?, ?, ?, ?)',
+                                 [(filename, name) + mark for mark in _iter_marks(node)])
+        self._db.execute('INSERT INTO files (path, sha256, mtime, size, unmarked) VALUES (?, ?, ?, ?, ?)',
+                         (filename, FileCache.file_hash(filename), stat.st_mtime, stat.st_size,
+                          len(set(r['line_number'] for r in self._detector.check_tree(tree, filename)))))
+
+
+def _iter_tests(body, prefix):
+    """Find the test definitions of a module or class body, and of the classes nested in it
+
+    Args:
+        body (list[ast.AST]): the statements of the module or class
+        prefix (str): the qualified name of the enclosing classes ex: 'TestFoo.'
+
+    Yields:
+        tuple(str, ast.AST): the qualified name and the node of each test definition
+    """
+    for node in body:
+        if type(node) in (ast.FunctionDef, ast.ClassDef) and AstDetector.test_def_regex.match(node.name):
+            yield prefix + node.name, node
+        if type(node) == ast.ClassDef:
+            for test in _iter_tests(node.body, prefix + node.name + '.'):
+                yield test
+
+
+def _iter_marks(node):
+    """Find the pytest marks of a definition and their values
+
+    Args:
+        node (ast.AST): the definition
+
+    Yields:
+        tuple(str, str, int): the mark name, value and the line of the value, the value is empty and the line is the
+            line of the decorator for a mark without arguments
+    """
+    for decorator in node.decorator_list:
+        call = decorator if isinstance(decorator, ast.Call) else None
+        func = call.func if call else decorator
+        try:
+            if func.value.attr != 'mark' or func.value.value.id != 'pytest':
+                continue
+        except AttributeError:
+            continue
+        values = []
+        for arg in call.args if call else ():
+            try:
+                values.append((str(ast.literal_eval(arg)), arg.lineno))
+            except ValueError:
+                pass  # not a literal, there is no value worth indexing
+        for value, line in values or [('', decorator.lineno)]:
+            yield func.attr, value, line
@@ -5,104 +5,430 @@
 # Imports
 # ======================================================================================================================
 from __future__ import absolute_import
-from flake8.main.cli import main as flake8_main
-from flake8.main.application import Application
-from contextlib import contextmanager
 from magic_marker.fixable import Fixable
-import sys
-import six
-import json
+from magic_marker.fixes import UuidFix
+from magic_marker.ids import IdRegistry
+from magic_marker.index import MarkIndex
+from magic_marker.report import FileReport, RunReport
+from magic_marker.timing import Timings, clock
+from magic_marker.detector import AstDetector, FileFinder
+from magic_marker.cache import FileCache, OptionsCache
+from magic_marker.vcs import changed_files
+from magic_marker.backup import Backup, ArchiveBackup, BackupStore, StoreBackup
+import functools
+import tokenize
+import difflib
+import copy
 import uuid
 import re
 import tempfile
 import string
 import random
+import time
 import shutil
-import errno
 import os
 
+# ======================================================================================================================
+# Globals
+# ======================================================================================================================
+DEFINITION = re.compile(r'(async\s+def|def|class)\s')
+_options_cache = {}  # OptionsCache.key (key), options of MagicMarker._load_options (value), for the life of the process
+
 
 class MagicMarker(object):
 
-    def __init__(self):
+    engines = ('flake8', 'ast')
+
+    def __init__(self, engine='flake8', jobs=None, cache_dir=None, full_backup=False, backup_strategy='copy',
+                 backup_format='dir', backup_store=None, check_ids=False, fix_duplicate_ids=False,
+                 index_dir=None, dry_run=False, backup_keep_runs=None, backup_max_size=None):
         """Crate a new MagicMarker object
+
+        Args:
+            engine (str): the engine used to detect unmarked tests, one of MagicMarker.engines
+            jobs (int): the number of worker processes used to fix files, defaults to the CPU count
+            cache_dir (str): a directory used to remember files that had nothing to fix, no cache is used if None
+            full_backup (bool): backup the whole target up front instead of only the files about to be rewritten
+            backup_strategy (str): how files are copied into the backup, one of Backup.strategies
+            backup_format (str): 'dir' for a directory tree, one of ArchiveBackup.formats for a compressed tar or
+                                 'store' for a content-addressed store shared by every run
+            backup_store (BackupStore): the store used by the 'store' backup format, defaults to BackupStore()
+            check_ids (bool): mint IDs that collide with none already in the target and report duplicated IDs, the IDs
+                              are read from the MarkIndex, or from an index kept in memory when there is no index_dir
+            fix_duplicate_ids (bool): give every duplicated ID but the first a new value, implies check_ids
+            index_dir (str): a directory used to keep a MarkIndex, files it knows are fully marked are skipped
+            dry_run (bool): work out the fixes in memory and record them as a diff, nothing is written or backed up
+            backup_keep_runs (int): the number of most recent archive backups to keep, every archive is kept if None
+            backup_max_size (int): the number of bytes of archive backups to keep at most
         """
+        if engine not in self.engines:
+            raise RuntimeError("Magic Marker does not know the detection engine '{}'".format(engine))
+        if backup_strategy not in Backup.strategies:
+            raise RuntimeError("Magic Marker does not know the backup strategy '{}'".format(backup_strategy))
+        if backup_format not in ('dir', 'store') and backup_format not in ArchiveBackup.formats:
+            raise RuntimeError("Magic Marker does not know the backup format '{}'".format(backup_format))
         self.options = None
-        dir_name = ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in range(10))
-        self._backup_path = os.path.join(tempfile.gettempdir(), dir_name)
+        self.file_finder = FileFinder()
+        self._engine = engine
+        self._jobs = jobs or _cpu_count()
+        self._cache_dir = cache_dir
+        self._full_backup = full_backup
+        self._backup_strategy = backup_strategy
+        self._backup_format = backup_format
+        self._backup = None
+        self._backup_store = (backup_store or BackupStore()) if backup_format == 'store' else None
+        self._backup_keep_runs = backup_keep_runs
+        self._backup_max_size = backup_max_size
+        self._new_backup_path()
+        self._check_ids = check_ids or fix_duplicate_ids
+        self._fix_duplicate_ids = fix_duplicate_ids
+        self._ids = None
+        self._ids_index = None  # the MarkIndex kept in memory for IdRegistry when there is no index_dir
+        self._index_dir = index_dir
+        self._index = None
+        self._dry_run = dry_run
+        self._diffs = []
+        self._report = None
+        self._timing_hooks = []
+        self._timings = Timings()
         self._fixable = Fixable()
+        self._flake8 = None  # (config, Flake8Engine)
+
+    def __getstate__(self):
+        """Drop what only the parent process uses so a MagicMarker can be sent to a worker process
+
+        IDs are minted, files are backed up, the index is updated and the time is kept in the parent process, workers
+        never need them and the flake8 engine is loaded again when needed.
+
+        Returns:
+            dict: the picklable state
+        """
+        state = self.__dict__.copy()
+        state['_flake8'] = None
+        state['_ids'] = None
+        state['_index'] = None
+        state['_ids_index'] = None
+        state['_backup'] = None  # an archive holds an open tarfile
+        state['_timings'] = None
+        state['_timing_hooks'] = []
+        return state
 
     @property
     def backup_path(self):
         return self._backup_path
 
+    @property
+    def diff(self):
+        """The unified diff of the fixes worked out by the last dry run
+
+        Returns:
+            str
+        """
+        return ''.join(self._diffs)
+
+    @property
+    def report(self):
+        """The structured record of the last run
+
+        Returns:
+            RunReport: None before the first run
+        """
+        return self._report
+
+    @property
+    def timings(self):
+        """Where the time of the last run went
+
+        Returns:
+            Timings
+        """
+        return self._timings
+
+    def add_timing_hook(self, hook):
+        """Follow the phases of every run as they end, for callers embedding MagicMarker
+
+        Args:
+            hook (callable): called with the name and seconds of each phase, see Timings.phase
+        """
+        self._timing_hooks.append(hook)
+
+    def _new_backup_path(self):
+        """Pick a new, random location for the next backup"""
+        dir_name = ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in range(10))
+        self._backup_path = os.path.join(tempfile.gettempdir(), dir_name)
+        if self._backup_format == 'store':
+            self._run_name = '{}-{}'.format(time.strftime('%Y%m%d%H%M%S'), dir_name)
+            self._backup_path = self._backup_store.run_path(self._run_name)
+        elif self._backup_format != 'dir':
+            self._backup_path += '.' + self._backup_format
+
     def find_options(self, config):
-        """Use flake8's library to find a valid config for flake8"""
-        flk8 = Application()
-        args = []
-        if config:
-            args.append("--config={}".format(config))
-        flk8.initialize(args)
-        opts = {}
-        for key, value in list(vars(flk8.options).items()):
-            if re.match(r'pytest_mark.*', key):
-                for option in value:
-                    try:
-                        opts[key]
-                    except KeyError:
-                        opts[key] = {}
-                    val = option.split('=')
-                    opts[key][val[0]] = val[1]
-        self.options = opts
-
-    def run_flake8_and_mark(self, path, config):
+        """Use flake8's library to find a valid config for flake8
+
+        The mark configuration and the options telling which files flake8 checks are remembered for as long as the
+        config files are unchanged, for the life of the process and, when a cache directory is used, between runs.
+
+        Args:
+            config (str): The path to a config to be passed to flake8
+        """
+        key = OptionsCache.key(config)
+        opts = _options_cache.get(key)
+        if opts is None and self._cache_dir:
+            opts = OptionsCache(self._cache_dir).get(key)
+        if opts is None:
+            opts = self._load_options(config)
+            if self._cache_dir:
+                OptionsCache(self._cache_dir).put(key, opts)
+        _options_cache[key] = opts
+        self.options = copy.deepcopy(opts['marks'])
+        self.file_finder = FileFinder(**opts['files'])
+        self._fixable.load(self.options)
+
+    def _load_options(self, config):
+        """Initialize flake8 to read the mark configuration and the options telling which files it checks
+
+        Args:
+            config (str): The path to a config to be passed to flake8
+
+        Returns:
+            dict: the mark configuration under 'marks', mark config name (key), dict (value), and the FileFinder
+                  options under 'files'
+        """
+        engine = self._flake8_engine(config)
+        return {'marks': engine.mark_configuration(), 'files': engine.file_finder().to_dict()}
+
+    def _flake8_engine(self, config):
+        """The flake8 engine for a config, plug-ins and configuration are only loaded once per MagicMarker
+
+        Args:
+            config (str): The path to a config to be passed to flake8
+
+        Returns:
+            Flake8Engine
+        """
+        if self._flake8 is None or self._flake8[0] != config:
+            from magic_marker.flake8_engine import Flake8Engine  # flake8 is only loaded once a lint actually runs
+            self._flake8 = (config, Flake8Engine(config))
+        return self._flake8[1]
+
+    def run_flake8_and_mark(self, path, config, changed_since=None, files=None):
         """Run flak8 and edit and fix errors
 
         Args:
             path (str): The path to target for the fix
             config (str): The path to a config to be passed to flake8
+            changed_since (str): only target the files added or modified since this git ref
+            files (list[str]): only target these files of the path
 
         Returns:
             str: the message stating what was performed
         """
 
+        self._timings = timings = Timings(self._timing_hooks)
+        with timings.phase('options'):
+            self.find_options(config)
+        cache = FileCache(self._cache_dir, FileCache.fingerprint(self.options)) if self._cache_dir else None
+        index = self._mark_index()
+        if index:
+            with timings.phase('index'):
+                index.update(path)
+        with timings.phase('discover'):
+            if changed_since:
+                files = changed_files(path, changed_since)
+            if files is not None:
+                # flake8 checks any file it is given, whatever its exclude and filename options
+                files = [f for f in files if self.file_finder.includes(f, path)]
+            skip = []  # checks telling which files have nothing to fix
+            if cache:
+                skip.append(cache.is_clean)
+            if index:
+                skip.append(index.is_fully_marked)
+            if skip:
+                candidates = list(self.file_finder.iter_files(path) if files is None else files)
+                targets = [f for f in candidates if not any(known(f) for known in skip)]
+                timings.count('files skipped', len(candidates) - len(targets))
+            else:
+                targets = [path] if files is None else files
+
+        self._diffs = []
+        if os.path.exists(self._backup_path):
+            self._new_backup_path()  # an earlier run was backed up there
+        with timings.phase('backup'):
+            self._backup = None if self._dry_run else self._make_backup(path)
+            if self._backup and self._full_backup and files is None:
+                self._backup.add_tree()
+            elif self._backup and self._full_backup:
+                for filename in files:
+                    self._backup.add(filename)
+        fix_run = _FixRun(self)
+        duplicates = []
+
+        def on_file(filename, violations):
+            timings.count('files checked')
+            timings.count('violations', len(violations))
+            if cache and not violations:
+                cache.mark_clean(filename)
+            fix_run.submit(violations)
+
+        try:
+            if self._check_ids:
+                with timings.phase('ids'):
+                    duplicates = self._scan_ids(path, index)
+            if not targets:
+                pass  # everything is known to be clean, flake8 would lint the working directory if given no paths
+            elif self._engine == 'ast':
+                detector = AstDetector(self.options, self.file_finder)
+                with timings.phase('detect'):
+                    for target in targets:
+                        for filename in detector.iter_files(target):
+                            on_file(filename, detector.check_file(filename))
+            else:
+                with timings.phase('load flake8'):
+                    engine = self._flake8_engine(config)
+                with timings.phase('detect'):
+                    engine.check(targets, on_file)
+            file_reports = fix_run.results()
+            if index:
+                with timings.phase('index'):
+                    index.refresh(file_report.filename for file_report in file_reports if file_report.count)
+        finally:
+            fix_run.close()
+            if self._backup:
+                with timings.phase('backup'):
+                    self._backup.close()
+            backup = self._backup_location()
+            self._backup = None  # a backup only lives for the run that made it
+            self._ids = None
+            self._close_index()
+
+        if cache:
+            with timings.phase('cache'):
+                for file_report in file_reports:
+                    if not file_report.count:
+                        cache.mark_clean(file_report.filename)
+                cache.save()
+        self._report = RunReport(file_reports, duplicates, self._fix_duplicate_ids and not self._dry_run,
+                                 backup, self._dry_run)
+        timings.count('marks added', self._report.marks_added)
+        return self._report.message()
+
+    def watch(self, path, config, on_run, debounce=0.3, interval=0.5):
+        """Mark the tests of the files under a path as they are saved, until interrupted
+
+        The configuration and flake8 are loaded once up front, each batch of saved files is then checked and fixed
+        on its own with a backup of its own.
+
+        Args:
+            path (str): The path to watch
+            config (str): The path to a config to be passed to flake8
+            on_run (callable): called with the message stating what was performed, after each batch that changed files
+            debounce (float): the seconds without a save that end a batch
+            interval (float): the seconds between two scans of the tree, when inotify is not available
+        """
+        from magic_marker.watch import make_watcher, iter_batches
+
         self.find_options(config)
-        args = [
-            'flake8',
-            path,
-            "--format=json",
-            "--select=M5"  # only covers case of no mark present
-        ]
-        if config:
-            args.append("--config={}".format(config))
+        if self._engine == 'flake8':
+            self._flake8_engine(config)
+        watcher = make_watcher(path, interval, self.file_finder)
+        written = {}  # filename (key), size and mtime after it was fixed (value)
+        try:
+            for batch in iter_batches(watcher, debounce):
+                batch = [f for f in batch if written.pop(f, None) != _file_state(f)]
+                if not batch:
+                    continue  # only the files fixed by the previous batch were written
+                message = self.run_flake8_and_mark(path, config, files=batch)
+                if message:
+                    for filename in batch:
+                        written[filename] = _file_state(filename)
+                    on_run(message)
+                    self._new_backup_path()
+        finally:
+            watcher.close()
+
+    def _scan_ids(self, path, index):
+        """Look up every ID under a path in the index, replacing the duplicated ones if asked to
+
+        The whole path is looked up even when only some files are targeted, as an ID has to be unique across it. When
+        no index is kept the IDs come from an index kept in memory for the life of the MagicMarker, either way only the
+        files changed since the last update are parsed. Duplicates are replaced before any mark is added, so the line
+        numbers reported by the checks stay valid.
+
+        Args:
+            path (str): the target being fixed
+            index (MarkIndex): the index of the run, already updated, or None
+
+        Returns:
+            list[tuple(str, str, list[tuple(str, int)])]: mark name, value and locations of each duplicated ID
+        """
+        if index is None:
+            if self._ids_index is None:
+                self._ids_index = MarkIndex(None, self.options, self.file_finder)
+            index = self._ids_index
+            index.update(path)
+        self._ids = IdRegistry(index, [conf['name'] for conf in self.options.values()
+                                       if conf.get('value_match') == 'uuid'])
+        duplicates = self._ids.duplicates(path)
+        if not self._fix_duplicate_ids or self._dry_run:
+            return duplicates
+
+        replacements = {}  # filename (key), line index (key), list of (old, new) values (value)
+        for mark_name, value, locations in duplicates:
+            for (filename, number), new_value in zip(locations[1:], self._ids.mint(mark_name, len(locations) - 1)):
+                replacements.setdefault(filename, {}).setdefault(number - 1, []).append((value, new_value))
+        for filename in sorted(replacements):
+            self._backup.add(filename)  # a full backup may only hold the files targeted, see run_flake8_and_mark
+            self._rewrite_file(filename, {}, replacements[filename])
+        index.refresh(sorted(replacements))
+        return duplicates
+
+    def _mint_ids(self, fixes_required):
+        """Mint the IDs every UUID mark of a file needs in one go
+
+        Args:
+            fixes_required (list[dict]): a list of the fixes required for a single file
+
+        Returns:
+            dict: mark name (key), list of IDs (value) or None when IDs are not checked
+        """
+        if self._ids is None:
+            return None
+        counts = {}
+        for fix in fixes_required:
+            mark_name, prescribed_fix = self._fixable.check(fix, self.options)
+            if isinstance(prescribed_fix, UuidFix):
+                counts[mark_name] = counts.get(mark_name, 0) + 1
+        return {mark_name: self._ids.mint(mark_name, count) for mark_name, count in counts.items()}
 
-        with self.patch_sys_argv(args), self.captured_stdout() as stdout:
-            try:
-                flake8_main()
-            except SystemExit:
-                pass  # This is raised by flake8
+    def _make_backup(self, path):
+        """Create the backup of a target
 
-        flake8_output = json.loads(stdout.getvalue())
-        self._backup_whole_path(path)
-        return self.fix_it(flake8_output)
+        Args:
+            path (str): the target being fixed
 
-    def _backup_whole_path(self, path):
-        """Backup the entire target
+        Returns:
+            Backup: the backup, nothing is copied yet
+        """
+        if self._backup_format == 'dir':
+            return Backup(self._backup_path, path, self._backup_strategy)
+        if self._backup_format == 'store':
+            return StoreBackup(path, self._backup_store, self._run_name)
+        return ArchiveBackup(self._backup_path, path, self._backup_format, self._backup_keep_runs,
+                             self._backup_max_size)
+
+    def _backup_before_fix(self, fixes_required):
+        """Backup a file that is about to be rewritten, unless the whole target was backed up already
 
         Args:
-            path (str): the path to copy
+            fixes_required (list[dict]): a list of the fixes required for a single file
         """
-        try:
-            shutil.copytree(path, self._backup_path)
-        except OSError as exc:  # python >2.5
-            if exc.errno == errno.ENOTDIR:
-                # its a single file
-                shutil.copy(path, self.backup_path)
-            else:
-                raise RuntimeError("Magic Marker was not able to backup the target {}".format(path))
+        if self._backup is None or self._full_backup:
+            return
+        if any(self._fixable.check(fix, self.options)[1] for fix in fixes_required):
+            self._backup.add(str(fixes_required[0]['filename']))
 
     def fix_it(self, flake8_output):
-        """Perform the fix
+        """Perform the fix, the files are not backed up, as only run_flake8_and_mark knows the target to backup
 
         Args:
             flake8_output (str): The parsed json data from flake8-json
@@ -110,47 +436,230 @@ class MagicMarker(object):
         Returns:
             str: the message stating what was performed
         """
-        message = ""
-        for file_path in flake8_output:
-            if flake8_output[file_path]:
-                filname, fixcount = self._fix_file(flake8_output[file_path])
-                if fixcount == 1:
-                    message += "\n{} : {} test mark added".format(filname, fixcount)
-                else:
-                    message += "\n{} : {} test marks added".format(filname, fixcount)
-        if message:
-            return message
-
-    def _fix_file(self, fixes_required):
+        self._diffs = []
+        self._timings = Timings(self._timing_hooks)
+        fix_run = _FixRun(self)
+        index = self._mark_index()
+        try:
+            for file_path in flake8_output:
+                if index and index.is_fully_marked(file_path):
+                    continue  # the output is stale, the file was marked since it was linted
+                fix_run.submit(flake8_output[file_path])
+            file_reports = fix_run.results()
+            if index:
+                with self._timings.phase('index'):
+                    index.refresh(file_report.filename for file_report in file_reports if file_report.count)
+            self._report = RunReport(file_reports, dry_run=self._dry_run)
+            self._timings.count('marks added', self._report.marks_added)
+            return self._report.message()
+        finally:
+            fix_run.close()
+            self._close_index()
+
+    def _mark_index(self):
+        """The index of the tests, opened for the mark configuration in use
+
+        Returns:
+            MarkIndex: the index or None if no index is kept
+        """
+        if self._index_dir and self._index is None:
+            self._index = MarkIndex(self._index_dir, self.options, self.file_finder)
+        return self._index
+
+    def _close_index(self):
+        """Close the index, if one is open"""
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    def _backup_location(self):
+        """The location of the backup of the last run
+
+        Returns:
+            str: the path of the backup or None if nothing was backed up
+        """
+        if self._backup is not None and os.path.exists(self._backup_path):
+            return self._backup_path
+        return None
+
+    def _fix_file(self, fixes_required, ids=None):
         """Fixes an individual file
 
         Args:
             fixes_required (list[dict]): a list of the fixes required for this file
+            ids (dict): mark name (key), list of IDs minted for this file (value), the fixes generate them if None
+
+        Returns:
+            FileReport: the marks added to the file and the violations left alone
+        """
+        file_report = FileReport(str(fixes_required[0]['filename']))
+        marks = self._plan_marks(fixes_required, ids, file_report)
+        if file_report.count and self._dry_run:
+            self._diffs.append(self._diff(file_report.filename, marks))
+        elif file_report.count:
+            self._rewrite_file(file_report.filename, marks)
+        return file_report
+
+    def _diff(self, filename, marks):
+        """Work out the fix of a file in memory
+
+        Args:
+            filename (str): the path of the file to fix
+            marks (dict): line index (key), list of marks to place above that line (value)
 
         Returns:
-            tuple(str, str):  filename and number of fixes performed
+            str: the unified diff of the fix, with 'a/' and 'b/' paths relative to the current directory as git writes
+                them so that 'git apply' or 'patch -p1' can apply it
         """
-        fixes_performed = 0
-        filename = str(fixes_required[0]['filename'])
         with open(filename, 'r') as f:
-            data = f.readlines()
+            original = f.readlines()
+        path = os.path.relpath(filename).replace(os.sep, '/')
+        return ''.join(difflib.unified_diff(original, list(self._splice(original, marks)),
+                                            'a/{}'.format(path), 'b/{}'.format(path)))
 
+    def mark_source(self, source, filename='<buffer>'):
+        """Fix the unmarked tests of python source held in memory, found with the native detector
+
+        Nothing is written and nothing is backed up, the mark configuration must be loaded with find_options first.
+
+        Args:
+            source (str): the python source
+            filename (str): the name of the file the source belongs to
+
+        Returns:
+            tuple(str, int): the fixed source and the number of marks added
+        """
+        marks = self._plan_marks(AstDetector(self.options).check_source(source, filename))
+        if not marks:
+            return source, 0
+        return ''.join(self._splice(source.splitlines(True), marks)), sum(len(m) for m in marks.values())
+
+    def _plan_marks(self, fixes_required, ids=None, file_report=None):
+        """Generate the marks that fix the violations of a file
+
+        Args:
+            fixes_required (list[dict]): a list of the fixes required for a single file
+            ids (dict): mark name (key), list of IDs minted for this file (value), the fixes generate them if None
+            file_report (FileReport): records the marks planned and the violations left alone, if given
+
+        Returns:
+            dict: line index (key), marks to place above that line in order (value)
+        """
         fixes_required.sort(key=lambda x: x['line_number'])
 
-        fixes_required.reverse()  # work from the bottom of the file up
+        prescribed = []  # (line index, line of the definition, mark name, fix) in the order of the file
+        counts = {}  # (mark name, fix) (key), number of marks needed (value)
         for fix in fixes_required:
             mark_name, prescribed_fix = self._fixable.check(fix, self.options)
             if prescribed_fix:
                 fix_position = fix['line_number']
                 if fix_position:
                     fix_position += -1
-                mark = self._match_indent(data[fix_position], prescribed_fix(mark_name))
-                data.insert(fix_position, mark)
-                fixes_performed += 1
+                prescribed.append((fix_position, fix['line_number'], mark_name, prescribed_fix))
+                counts[(mark_name, prescribed_fix)] = counts.get((mark_name, prescribed_fix), 0) + 1
+            elif file_report is not None:
+                file_report.skip(fix)
+
+        values = {}  # mark name (key), iterator over the values of its marks (value)
+        for (mark_name, prescribed_fix), count in counts.items():
+            batch = (ids or {}).get(mark_name) or prescribed_fix.values(mark_name, count)
+            values[mark_name] = iter(batch)
+
+        marks = {}  # line index (key), marks to place above that line in order (value)
+        for fix_position, line_number, mark_name, prescribed_fix in prescribed:
+            value = next(values[mark_name])
+            marks.setdefault(fix_position, []).append(prescribed_fix(mark_name, value))
+            if file_report is not None:
+                file_report.add(line_number, mark_name, value)
+        return marks
+
+    def _rewrite_file(self, filename, marks, replacements=None):
+        """Stream a file through the splice into a new file next to it, then swap it in for the original
+
+        The original is never modified in place, so a crash leaves either the original or the fixed file behind
+        and a hard linked backup is never changed. A symbolic link is followed, the file it points to is replaced.
+
+        Args:
+            filename (str): the path of the file to fix
+            marks (dict): line index (key), list of marks to place above that line (value)
+            replacements (dict): line index (key), list of (old, new) values to swap on that line (value)
+        """
+        filename = os.path.realpath(filename)
+        directory = os.path.dirname(filename)
+        fd, temp_path = tempfile.mkstemp(prefix='.{}.'.format(os.path.basename(filename)), suffix='.tmp', dir=directory)
+        replaced = False
+        try:
+            with os.fdopen(fd, 'w') as f, open(filename, 'r') as source:
+                f.writelines(self._splice(source, marks, replacements))
+                f.flush()
+                os.fsync(f.fileno())
+            shutil.copymode(filename, temp_path)
+            _replace(temp_path, filename)
+            replaced = True
+        except (IOError, OSError):
+            raise RuntimeError("Magic Marker was not able to rewrite the file {}".format(filename))
+        finally:
+            if not replaced:
+                os.remove(temp_path)  # whatever went wrong, ex: a KeyboardInterrupt or a file that is not text
+        _fsync_directory(directory)
 
-        with open(filename, 'w') as f:
-            f.writelines(data)
-        return filename, fixes_performed
+    @classmethod
+    def _splice(cls, lines, marks, replacements=None):
+        """Merge marks into the lines of a file in a single pass
+
+        The marks of a decorated definition are placed above its decorators. The lines of a run of decorators are
+        held back until the line after them shows whether they decorate a definition to mark, only those lines are
+        ever held in memory.
+
+        Args:
+            lines (iterable[str]): the original lines of the file
+            marks (dict): line index (key), list of marks to place above that line (value)
+            replacements (dict): line index (key), list of (old, new) values to swap on that line (value)
+
+        Yields:
+            str: the lines of the fixed file
+
+        Raises:
+            RuntimeError: a mark is placed beyond the end of the file
+        """
+        held = []  # the lines of the decorators read since the last statement
+        indent = None  # the indent of the held decorators
+        complete = True  # whether the held lines end with a complete decorator
+        number = -1
+        for number, line in enumerate(lines):
+            for old, new in (replacements or {}).get(number, ()):
+                line = line.replace(old, new, 1)
+            if held:
+                stripped = line.strip()
+                if complete and _indent(line) == indent and DEFINITION.match(stripped):
+                    for mark in marks.get(number, ()):
+                        yield cls._match_indent(line, mark)
+                    for held_line in held:
+                        yield held_line
+                    held = []
+                    yield line
+                    continue
+                if not complete or not stripped or stripped.startswith('#') or \
+                        (stripped.startswith('@') and _indent(line) == indent):
+                    held.append(line)
+                    complete = _is_complete(held)
+                    continue
+                for held_line in held:  # not decorators after all, ex: a line of a string starting with @
+                    yield held_line
+                held = []
+            for mark in marks.get(number, ()):
+                yield cls._match_indent(line, mark)
+            if line.lstrip().startswith('@'):
+                held = [line]
+                indent = _indent(line)
+                complete = _is_complete(held)
+                continue
+            yield line
+        for held_line in held:
+            yield held_line
+        if marks and max(marks) > number:
+            raise RuntimeError("Magic Marker can not mark line {}, "
+                               "the file ends at line {}".format(max(marks) + 1, number + 1))
 
     def _uuid_mark(self):
         """generate a UUID mark string
@@ -176,48 +685,170 @@ class MagicMarker(object):
             target_line = whitespace + target_line
         return target_line
 
-    @contextmanager
-    def patch_sys_argv(self, new_argv):
-        """Patch argv
 
-        Args:
-            new_argv (list): the desired argv
+class _FixRun(object):
+    """Fixes files as they are submitted, spreading the work across a pool of worker processes when it pays off"""
 
-        Yields:
-            None
-        """
-        orig = sys.argv
-        sys.argv = new_argv
-        yield
-        sys.argv = orig
-
-    @contextmanager
-    def captured_output(self, stream_name):
-        """Return a context manager used by captured_stdout/stdin/stderr
-        that temporarily replaces the sys stream *stream_name* with a StringIO.
+    def __init__(self, magic_marker):
+        """Create a new _FixRun object
 
         Args:
-            stream_name (str): The name of the stream to capture
+            magic_marker (MagicMarker): the MagicMarker performing the fixes
+        """
+        self._magic_marker = magic_marker
+        self._pool = None
+        self._results = []
 
-        Yields:
-            StringIO
+    def submit(self, fixes_required):
+        """Fix a file, or queue it on the worker pool
 
-        Note: This function and the following ``captured_std*`` are copied
-              from CPython's ``test.support`` module."""
-        orig_stdout = getattr(sys, stream_name)
-        setattr(sys, stream_name, six.StringIO())
-        try:
-            yield getattr(sys, stream_name)
-        finally:
-            setattr(sys, stream_name, orig_stdout)
+        The first file is fixed in-process, the pool is only started once a second file shows up
 
-    def captured_stdout(self):
-        """Capture the output of sys.stdout:
-           with captured_stdout() as stdout:
-               print("hello")
-           self.assertEqual(stdout.getvalue(), "hello\n")
+        Args:
+            fixes_required (list[dict]): a list of the fixes required for a single file
+        """
+        if not fixes_required:
+            return
+        timings = self._magic_marker._timings
+        with timings.phase('backup'):
+            self._magic_marker._backup_before_fix(fixes_required)
+        ids = None
+        if self._magic_marker._ids is not None:
+            with timings.phase('ids'):
+                ids = self._magic_marker._mint_ids(fixes_required)
+        job = (self._magic_marker, fixes_required, ids)
+        if self._pool is None and self._results and self._magic_marker._jobs > 1 and not self._magic_marker._dry_run:
+            import multiprocessing
+            with timings.phase('start workers'):
+                self._pool = multiprocessing.Pool(self._magic_marker._jobs)
+        if self._pool is None:
+            with timings.phase('fix'):
+                self._results.append((False, _fix_file_worker(job)))
+        else:
+            self._results.append((True, self._pool.apply_async(_fix_file_worker, (job,))))
+
+    def results(self):
+        """Wait for every submitted file to be fixed
 
         Returns:
-            GeneratorContextManager
+            list[FileReport]: the report of every file, in the order the files were submitted
         """
-        return self.captured_output("stdout")
+        timings = self._magic_marker._timings
+        file_reports = []
+        with timings.phase('fix'):
+            for pending, result in self._results:
+                file_report, seconds = result.get() if pending else result
+                timings.record_file(file_report.filename, seconds)
+                if file_report.count:
+                    timings.count('files fixed')
+                file_reports.append(file_report)
+        return file_reports
+
+    def close(self):
+        """Shut down the worker pool"""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def _cpu_count():
+    """The number of CPUs, without importing multiprocessing where the os module can tell
+
+    Returns:
+        int
+    """
+    try:
+        return os.cpu_count() or 1
+    except AttributeError:  # python 2
+        import multiprocessing
+        return multiprocessing.cpu_count()
+
+
+def _file_state(filename):
+    """The size and mtime of a file
+
+    Args:
+        filename (str): the path of the file
+
+    Returns:
+        tuple(int, float): None if the file does not exist
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+def _indent(line):
+    """The leading whitespace of a line
+
+    Args:
+        line (str): the line
+
+    Returns:
+        str
+    """
+    return line[:len(line) - len(line.lstrip())]
+
+
+def _is_complete(lines):
+    """Check whether lines of python hold complete statements, rather than ending inside of brackets or a string
+
+    Args:
+        lines (list[str]): the lines
+
+    Returns:
+        bool
+    """
+    try:
+        for _ in tokenize.generate_tokens(functools.partial(next, iter(lines), '')):
+            pass
+    except (tokenize.TokenError, SyntaxError):
+        return False
+    return True
+
+
+def _replace(source, destination):
+    """Atomically rename a file over another
+
+    Args:
+        source (str): the path of the new file
+        destination (str): the path of the file to replace
+    """
+    getattr(os, 'replace', os.rename)(source, destination)  # os.replace is not available on python 2
+
+
+def _fsync_directory(directory):
+    """Flush a directory entry to disk so a rename survives a crash, where the platform allows it
+
+    Args:
+        directory (str): the path of the directory
+    """
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except (OSError, AttributeError):
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _fix_file_worker(job):
+    """Fix an individual file, timing it, inside of a worker process or in-process
+
+    Args:
+        job (tuple(MagicMarker, list[dict], dict)): the MagicMarker to use, the fixes required for a single file and
+                                                    the IDs minted for it
+
+    Returns:
+        tuple(FileReport, float): the marks added to the file and the violations left alone, and the seconds it took
+    """
+    magic_marker, fixes_required, ids = job
+    start = clock()
+    file_report = magic_marker._fix_file(fixes_required, ids)
+    return file_report, clock() - start
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+"""The structured record of a run, from which the message, the JSON and the JSON Lines reports are rendered"""
+# ======================================================================================================================
+# Imports
+# ======================================================================================================================
+from __future__ import absolute_import
+import json
+
+# ======================================================================================================================
+# Globals
+# ======================================================================================================================
+REPORT_FORMATS = ('json', 'jsonl')
+
+
+class FileReport(object):
+    """What a run did to a single file, built by the process fixing it and sent back to the run"""
+
+    def __init__(self, filename):
+        """Create a new FileReport object
+
+        Args:
+            filename (str): the path of the file
+        """
+        self.filename = filename
+        self.marks = []  # dict of the line, mark and value of every mark added
+        self.skipped = []  # dict of the line, code and text of every violation no fix is known for
+
+    @property
+    def count(self):
+        """The number of marks added
+
+        Returns:
+            int
+        """
+        return len(self.marks)
+
+    def add(self, line, mark_name, value):
+        """Record a mark added
+
+        Args:
+            line (int): the line of the test definition, in the original file
+            mark_name (str): the name of the mark
+            value (str): the value of the mark, None for a mark without arguments
+        """
+        self.marks.append({'line': line, 'mark': mark_name, 'value': value})
+
+    def skip(self, violation):
+        """Record a violation that was left alone
+
+        Args:
+            violation (dict): details of output from flake8
+        """
+        self.skipped.append({'line': violation['line_number'], 'code': violation['code'], 'text': violation['text']})
+
+    def to_dict(self):
+        """The report as plain data
+
+        Returns:
+            dict
+        """
+        return {'filename': self.filename, 'marks': self.marks, 'skipped': self.skipped}
+
+
+class RunReport(object):
+    """What a run did, rendered as a message or serialized once the run is over"""
+
+    def __init__(self, files=(), duplicates=(), duplicates_fixed=False, backup=None, dry_run=False):
+        """Create a new RunReport object
+
+        Args:
+            files (list[FileReport]): the files that had violations, in the order they were checked
+            duplicates (list[tuple(str, str, list[tuple(str, int)])]): mark name, value and locations of each
+                                                                       duplicated ID
+            duplicates_fixed (bool): whether every duplicate but the first was given a new value
+            backup (str): the path of the backup or None if no backup was made
+            dry_run (bool): whether the fixes were only worked out, not performed
+        """
+        self.files = list(files)
+        self.duplicates = list(duplicates)
+        self.duplicates_fixed = duplicates_fixed
+        self.backup = backup
+        self.dry_run = dry_run
+
+    @property
+    def marks_added(self):
+        """The number of marks added across every file
+
+        Returns:
+            int
+        """
+        return sum(file_report.count for file_report in self.files)
+
+    def message(self):
+        """Render the message stating what was performed
+
+        Returns:
+            str: the message or None if nothing was found
+        """
+        lines = []
+        added = 'would be added' if self.dry_run else 'added'
+        for file_report in self.files:
+            lines.append("{} : {} test {} {}".format(file_report.filename, file_report.count,
+                                                     'mark' if file_report.count == 1 else 'marks', added))
+        for mark_name, value, locations in self.duplicates:
+            where = ', '.join('{}:{}'.format(filename, number) for filename, number in locations)
+            lines.append("Duplicate {} '{}' {} : {}".format(mark_name, value,
+                                                            'replaced' if self.duplicates_fixed else 'found', where))
+        if lines:
+            return '\n' + '\n'.join(lines)
+
+    def to_dict(self):
+        """The report as plain data
+
+        Returns:
+            dict
+        """
+        return {'files': [file_report.to_dict() for file_report in self.files],
+                'duplicates': [{'mark': mark_name, 'value': value,
+                                'locations': [{'filename': filename, 'line': number} for filename, number in locations]}
+                               for mark_name, value, locations in self.duplicates],
+                'duplicates_fixed': self.duplicates_fixed,
+                'marks_added': self.marks_added,
+                'backup': self.backup,
+                'dry_run': self.dry_run}
+
+    def iter_records(self):
+        """The report as a flat stream of records, the last one summing up the run
+
+        Yields:
+            dict: a record with its 'type' set to 'mark', 'skipped', 'duplicate' or 'summary'
+        """
+        for file_report in self.files:
+            for mark in file_report.marks:
+                yield dict(mark, type='mark', filename=file_report.filename)
+            for violation in file_report.skipped:
+                yield dict(violation, type='skipped', filename=file_report.filename)
+        for duplicate in self.to_dict()['duplicates']:
+            yield dict(duplicate, type='duplicate')
+        yield {'type': 'summary',
+               'files': len(self.files),
+               'marks_added': self.marks_added,
+               'duplicates_fixed': self.duplicates_fixed,
+               'backup': self.backup,
+               'dry_run': self.dry_run}
+
+    def write(self, f, report_format='json'):
+        """Serialize the report
+
+        Args:
+            f (file): the file to write to
+            report_format (str): one of REPORT_FORMATS, 'jsonl' writes a record per line
+
+        Raises:
+            RuntimeError: the format is not known
+        """
+        if report_format == 'json':
+            f.write(json.dumps(self.to_dict(), indent=2, sort_keys=True) + '\n')
+        elif report_format == 'jsonl':
+            for record in self.iter_records():
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+        else:
+            raise RuntimeError("Magic Marker does not know the report format '{}'".format(report_format))
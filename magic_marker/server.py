@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""A long-lived server answering JSON requests on a Unix socket, keeping the configuration and flake8 warm
+
+Requires python 3.5 or later. Each request is a JSON object on a single line, answered by a JSON object on a single
+line with 'ok' set and either the result or an 'error':
+    {"command": "mark", "files": ["/abs/path/test_foo.py"]}
+    {"command": "mark_source", "source": "def test_foo():...", "filename": "test_foo.py"}
+    {"command": "status"}
+"""
+# ======================================================================================================================
+# Imports
+# ======================================================================================================================
+from __future__ import absolute_import
+from magic_marker.cache import _make_cache_dir
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import socket
+import json
+import time
+import os
+
+
+class MarkServer(object):
+    """Serves the requests of editors and git hooks with a single MagicMarker
+
+    The event loop only reads and answers requests, marking happens one request at a time on a worker thread so a
+    status request is answered even while files are being marked.
+    """
+
+    def __init__(self, magic_marker, config, socket_path, root='.'):
+        """Create a new MarkServer object
+
+        Args:
+            magic_marker (MagicMarker): the MagicMarker used for every request
+            config (str): The path to a config to be passed to flake8
+            socket_path (str): the path of the Unix socket to listen on
+            root (str): the directory holding the files that may be marked, backups keep their layout relative to it
+        """
+        self._magic_marker = magic_marker
+        self._config = config
+        self._socket_path = socket_path
+        self._root = os.path.abspath(root)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._loop = None
+        self._started = time.time()
+        self._requests = 0
+        self._handlers = {'mark': self._mark, 'mark_source': self._mark_source, 'status': self._status}
+
+    def serve_forever(self):
+        """Load the configuration and flake8, then answer requests until stopped or interrupted
+
+        Raises:
+            RuntimeError: the socket is already served or can not be created
+        """
+        self._magic_marker.find_options(self._config)
+        if self._magic_marker._engine == 'flake8':
+            self._magic_marker._flake8_engine(self._config)
+        self._claim_socket()
+
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            server = self._loop.run_until_complete(asyncio.start_unix_server(self._handle, path=self._socket_path))
+        except OSError:
+            raise RuntimeError("Magic Marker was not able to listen on {}".format(self._socket_path))
+        try:
+            self._loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            self._loop.run_until_complete(server.wait_closed())
+            self._loop.close()
+            self._executor.shutdown()
+            if os.path.exists(self._socket_path):
+                os.remove(self._socket_path)
+
+    def stop(self):
+        """Stop serving, from any thread"""
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def _claim_socket(self):
+        """Remove the socket left behind by a server that is gone
+
+        Raises:
+            RuntimeError: another server is answering on the socket
+        """
+        directory = os.path.dirname(os.path.abspath(self._socket_path))
+        _make_cache_dir(directory)
+        if not os.path.exists(self._socket_path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self._socket_path)
+        except (IOError, OSError):
+            os.remove(self._socket_path)
+            return
+        finally:
+            probe.close()
+        raise RuntimeError("Magic Marker is already serving on {}".format(self._socket_path))
+
+    async def _handle(self, reader, writer):
+        """Answer the requests of a connection until the client closes it
+
+        Args:
+            reader (asyncio.StreamReader): the requests
+            writer (asyncio.StreamWriter): the responses
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = await self._respond(line)
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass  # the client went away
+        finally:
+            writer.close()
+
+    async def _respond(self, line):
+        """Answer a single request
+
+        Args:
+            line (bytes): the JSON request
+
+        Returns:
+            dict: the response
+        """
+        try:
+            request = json.loads(line.decode('utf-8'))
+            handler = self._handlers[request['command']]
+        except (ValueError, KeyError, TypeError):
+            return {'ok': False, 'error': "Magic Marker did not understand the request"}
+        self._requests += 1
+        try:
+            if handler == self._status:
+                result = handler(request)
+            else:
+                result = await self._loop.run_in_executor(self._executor, handler, request)
+        except (RuntimeError, IOError, OSError, KeyError, TypeError) as e:
+            return {'ok': False, 'error': str(e)}
+        result['ok'] = True
+        return result
+
+    def _mark(self, request):
+        """Mark the tests of files, on the worker thread
+
+        Args:
+            request (dict): the request, with the absolute paths of the 'files'
+
+        Returns:
+            dict: the message stating what was performed, the path of the backup, if one was needed, and the report
+
+        Raises:
+            RuntimeError: a file is outside of the root of the server
+        """
+        files = [os.path.abspath(f) for f in request['files']]
+        for filename in files:
+            if not filename.startswith(os.path.join(self._root, '')):
+                raise RuntimeError("Magic Marker only marks the files under {}, not {}".format(self._root, filename))
+        self._magic_marker.find_options(self._config)
+        message = self._magic_marker.run_flake8_and_mark(self._root, self._config, files=files)
+        report = self._magic_marker.report
+        if report.backup:
+            self._magic_marker._new_backup_path()
+        return {'message': message, 'backup': report.backup, 'report': report.to_dict()}
+
+    def _mark_source(self, request):
+        """Mark the tests of a source buffer, on the worker thread
+
+        Args:
+            request (dict): the request, with the 'source' and optionally the 'filename' it belongs to
+
+        Returns:
+            dict: the fixed source and the number of marks added
+        """
+        self._magic_marker.find_options(self._config)
+        source, count = self._magic_marker.mark_source(request['source'], request.get('filename', '<buffer>'))
+        return {'source': source, 'marks_added': count}
+
+    def _status(self, request):
+        """Describe the server, on the event loop
+
+        Args:
+            request (dict): the request
+
+        Returns:
+            dict: the process ID, uptime in seconds, number of requests and the root of the server
+        """
+        return {'pid': os.getpid(),
+                'uptime': time.time() - self._started,
+                'requests': self._requests,
+                'root': self._root}
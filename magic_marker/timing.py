@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""Phase timers, per-file timings and counts of a run, and a cProfile wrapper for looking deeper"""
+# ======================================================================================================================
+# Imports
+# ======================================================================================================================
+from __future__ import absolute_import
+import contextlib
+import time
+
+# ======================================================================================================================
+# Globals
+# ======================================================================================================================
+clock = getattr(time, 'perf_counter', time.time)  # time.perf_counter is not available on python 2
+HISTOGRAM_BUCKETS = (0.001, 0.01, 0.1, 1.0)  # upper bounds in seconds, the last bucket holds everything slower
+
+
+class Timings(object):
+    """Where the time of a run went
+
+    Phases may nest, the time of a phase excludes the phases run inside of it so the phases of a run add up to its
+    total. Hooks are called with the name and seconds of a phase each time one ends.
+    """
+
+    def __init__(self, hooks=()):
+        """Create a new Timings object
+
+        Args:
+            hooks (iterable[callable]): called with the name and seconds of each phase as it ends
+        """
+        self.phases = []  # phase names in the order they first ran
+        self.seconds = {}  # phase name (key), seconds spent in the phase itself (value)
+        self.counts = {}  # name (key), count (value)
+        self.file_seconds = {}  # filename (key), seconds spent fixing it (value)
+        self._hooks = list(hooks)
+        self._nested = []  # seconds spent in the phases run inside of each open phase
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a phase of the run
+
+        Args:
+            name (str): the name of the phase, the time of phases of the same name adds up
+        """
+        self._nested.append(0.0)
+        start = clock()
+        try:
+            yield
+        finally:
+            elapsed = clock() - start
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+            if name not in self.seconds:
+                self.phases.append(name)
+                self.seconds[name] = 0.0
+            self.seconds[name] += elapsed - nested
+            for hook in self._hooks:
+                hook(name, elapsed)
+
+    def count(self, name, amount=1):
+        """Add to a count
+
+        Args:
+            name (str): the name of the count
+            amount (int): the amount to add
+        """
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def record_file(self, filename, seconds):
+        """Record the time spent fixing a file
+
+        Args:
+            filename (str): the path of the file
+            seconds (float): the time spent
+        """
+        self.file_seconds[filename] = seconds
+
+    @property
+    def total(self):
+        """The seconds spent in every phase
+
+        Returns:
+            float
+        """
+        return sum(self.seconds.values())
+
+    def histogram(self, buckets=HISTOGRAM_BUCKETS):
+        """Group the files by the time spent fixing them
+
+        Args:
+            buckets (tuple[float]): the upper bounds of the buckets in seconds, in increasing order
+
+        Returns:
+            list[tuple(str, int)]: the label and number of files of each bucket
+        """
+        counts = [0] * (len(buckets) + 1)
+        for seconds in self.file_seconds.values():
+            counts[sum(1 for bound in buckets if seconds >= bound)] += 1
+        labels = ['< {}'.format(_duration(bound)) for bound in buckets] + ['>= {}'.format(_duration(buckets[-1]))]
+        return list(zip(labels, counts))
+
+    def table(self):
+        """Render the timings as a table
+
+        Returns:
+            str
+        """
+        lines = ['{:<24}{:>10}{:>8}'.format('Phase', 'Seconds', '%')]
+        total = self.total
+        for name in self.phases:
+            share = 100.0 * self.seconds[name] / total if total else 0.0
+            lines.append('{:<24}{:>10.3f}{:>8.1f}'.format(name, self.seconds[name], share))
+        lines.append('{:<24}{:>10.3f}'.format('total', total))
+        if self.counts:
+            lines.append('')
+            lines.append('Count')
+            for name in sorted(self.counts):
+                lines.append('{:<24}{:>10}'.format(name, self.counts[name]))
+        if self.file_seconds:
+            lines.append('')
+            lines.append('{:<24}{:>10}'.format('Fix time per file', 'Files'))
+            for label, files in self.histogram():
+                lines.append('{:<24}{:>10}'.format(label, files))
+        return '\n'.join(lines)
+
+
+@contextlib.contextmanager
+def profiled(path):
+    """Run the body under cProfile and save the statistics, for pstats or snakeviz
+
+    Only the current process is profiled, the worker processes fixing files are not.
+
+    Args:
+        path (str): the file to save the statistics to, nothing is profiled if None
+
+    Yields:
+        cProfile.Profile: the profiler or None
+    """
+    if path is None:
+        yield None
+        return
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+
+def _duration(seconds):
+    """Format a duration for a label
+
+    Args:
+        seconds (float): the duration
+
+    Returns:
+        str
+    """
+    if seconds < 1:
+        return '{:g} ms'.format(seconds * 1000)
+    return '{:g} s'.format(seconds)
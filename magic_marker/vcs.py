@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+"""Helpers for finding the test files touched in a git repository"""
+# ======================================================================================================================
+# Imports
+# ======================================================================================================================
+from __future__ import absolute_import
+import os
+
+
+def changed_files(path, ref):
+    """List the python files under a path that were added or modified since a git ref
+
+    Changes are taken relative to the merge base of the ref and HEAD, so only the work of the current branch counts.
+    Untracked files are considered added.
+
+    Args:
+        path (str): a file or directory inside of a git repository
+        ref (str): the git ref to compare against ex: 'origin/master'
+
+    Returns:
+        list[str]: the paths of the changed python files
+
+    Raises:
+        RuntimeError: git was not able to list the changes
+    """
+    import subprocess
+    cwd = path if os.path.isdir(path) else os.path.dirname(os.path.abspath(path))
+    target = os.path.abspath(path)
+    try:
+        top = _git(cwd, 'rev-parse', '--show-toplevel')[0]
+        base = _git(cwd, 'merge-base', ref, 'HEAD')[0]
+        names = _git(top, 'diff', '--name-only', '--diff-filter=AM', base, '--', target)
+        names += _git(top, 'ls-files', '--others', '--exclude-standard', '--', target)
+    except (OSError, subprocess.CalledProcessError, IndexError):
+        raise RuntimeError("Magic Marker was not able to list the files changed since {} under {}".format(ref, path))
+
+    files = []
+    for name in sorted(set(names)):
+        filename = os.path.join(top, name)
+        if name.endswith('.py') and os.path.isfile(filename):
+            files.append(filename)
+    return files
+
+
+def _git(cwd, *args):
+    """Run a git command
+
+    Args:
+        cwd (str): the directory to run git in
+        args (str): the git sub-command and its arguments
+
+    Returns:
+        list[str]: the lines of output
+    """
+    import subprocess
+    with open(os.devnull, 'w') as devnull:
+        output = subprocess.check_output(('git',) + args, cwd=cwd, stderr=devnull)
+    return output.decode('utf-8').splitlines()
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+"""Watch a tree for python files being saved, through inotify where the platform has it and polling otherwise"""
+# ======================================================================================================================
+# Imports
+# ======================================================================================================================
+from __future__ import absolute_import
+from magic_marker.detector import FileFinder
+import struct
+import select
+import time
+import os
+
+# ======================================================================================================================
+# Globals
+# ======================================================================================================================
+IN_CLOSE_WRITE = 0x00000008  # linux/inotify.h
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+def make_watcher(path, interval=0.5, file_finder=None):
+    """Create the best watcher the platform supports
+
+    Args:
+        path (str): the file or directory to watch
+        interval (float): the seconds between two scans when polling
+        file_finder (FileFinder): picks the files to watch as flake8 would, defaults to flake8's defaults
+
+    Returns:
+        InotifyWatcher or PollingWatcher
+    """
+    try:
+        return InotifyWatcher(path, file_finder)
+    except OSError:
+        return PollingWatcher(path, interval, file_finder)
+
+
+def iter_batches(watcher, debounce=0.3):
+    """Wait for files to change, grouping the changes that follow each other closely
+
+    Args:
+        watcher (InotifyWatcher or PollingWatcher): the watcher
+        debounce (float): the seconds without a change that end a batch
+
+    Yields:
+        list[str]: the python files that changed and still exist
+    """
+    while True:
+        changed = watcher.wait(None)
+        while True:
+            more = watcher.wait(debounce)
+            if not more:
+                break
+            changed |= more
+        changed = sorted(f for f in changed if os.path.isfile(f))
+        if changed:
+            yield changed
+
+
+class PollingWatcher(object):
+    """Finds the python files that changed by comparing their size and mtime between scans"""
+
+    def __init__(self, path, interval=0.5, file_finder=None, clock=time.time, sleep=time.sleep):
+        """Create a new PollingWatcher object, taking the first snapshot
+
+        Args:
+            path (str): the file or directory to watch
+            interval (float): the seconds between two scans
+            file_finder (FileFinder): picks the files to watch as flake8 would, defaults to flake8's defaults
+            clock (callable): returns the current time in seconds
+            sleep (callable): waits for a number of seconds
+        """
+        self._path = path
+        self._interval = interval
+        self._file_finder = file_finder or FileFinder()
+        self._clock = clock
+        self._sleep = sleep
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        """Take a snapshot of the python files
+
+        Returns:
+            dict: filename (key), tuple of size and mtime (value)
+        """
+        snapshot = {}
+        for filename in self._file_finder.iter_files(self._path):
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue  # deleted while scanning
+            snapshot[filename] = (stat.st_size, stat.st_mtime)
+        return snapshot
+
+    def wait(self, timeout):
+        """Wait for python files to change
+
+        Args:
+            timeout (float): the most seconds to wait, None to wait until something changes
+
+        Returns:
+            set[str]: the files that changed, empty if the timeout passed first
+        """
+        deadline = None if timeout is None else self._clock() + timeout
+        while True:
+            snapshot = self._scan()
+            changed = set(f for f, state in snapshot.items() if self._snapshot.get(f) != state)
+            self._snapshot = snapshot
+            if changed or (deadline is not None and self._clock() >= deadline):
+                return changed
+            self._sleep(self._interval if deadline is None else max(0, min(self._interval, deadline - self._clock())))
+
+    def close(self):
+        """Nothing is held open while polling"""
+        pass
+
+
+class InotifyWatcher(object):
+    """Follows the python files written under a tree with inotify, through ctypes
+
+    Directories created while watching are watched as well, an overflowing event queue is treated as every file
+    having changed.
+    """
+
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, path, file_finder=None):
+        """Create a new InotifyWatcher object, watching every directory of the tree
+
+        Args:
+            path (str): the file or directory to watch
+            file_finder (FileFinder): picks the files to watch as flake8 would, defaults to flake8's defaults
+
+        Raises:
+            OSError: inotify is not available
+        """
+        import ctypes
+        import ctypes.util
+
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self._libc.inotify_init1
+        except (OSError, AttributeError):
+            raise OSError("inotify is not available")
+        self._path = path
+        self._file_finder = file_finder or FileFinder()
+        self._file = None if os.path.isdir(path) else os.path.abspath(path)
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs = {}  # watch descriptor (key), directory (value)
+        if self._file:
+            self._add_watch(os.path.dirname(self._file))
+        else:
+            self._add_tree(path)
+
+    def _add_watch(self, directory):
+        """Watch a single directory
+
+        Args:
+            directory (str): the directory
+        """
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory) if hasattr(os, 'fsencode') else directory,
+                                          self.mask)
+        if wd >= 0:
+            self._dirs[wd] = directory
+
+    def _add_tree(self, path):
+        """Watch a directory and every directory under it, skipping the directories flake8 excludes
+
+        Args:
+            path (str): the directory
+        """
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs if not self._file_finder.is_excluded(os.path.join(root, d))]
+            self._add_watch(root)
+
+    def wait(self, timeout):
+        """Wait for python files to be written
+
+        Args:
+            timeout (float): the most seconds to wait, None to wait until something is written
+
+        Returns:
+            set[str]: the files written, empty if the timeout passed first
+        """
+        changed = set()
+        readable = select.select([self._fd], [], [], timeout)[0]
+        while readable:
+            buf = os.read(self._fd, 65536)
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(buf, offset)
+                name = buf[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+                offset += EVENT_HEADER.size + length
+                changed |= self._handle(wd, mask, name.decode('utf-8', 'replace'))
+            readable = select.select([self._fd], [], [], 0)[0]
+        return changed
+
+    def _handle(self, wd, mask, name):
+        """Turn an event into the files it concerns
+
+        Args:
+            wd (int): the watch descriptor
+            mask (int): the event mask
+            name (str): the name of the entry in the watched directory
+
+        Returns:
+            set[str]: the python files concerned
+        """
+        if mask & IN_Q_OVERFLOW:
+            return set(self._file_finder.iter_files(self._path))
+        directory = self._dirs.get(wd)
+        if directory is None or not name:
+            return set()
+        filename = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if not self._file and not self._file_finder.is_excluded(filename):
+                self._add_tree(filename)
+                found = self._file_finder.iter_files(filename)  # files may have been written before the watch was added
+                return set(f for f in found if self._file_finder.includes(f, self._path))
+            return set()
+        if not mask & (IN_CLOSE_WRITE | IN_MOVED_TO) or not self._file_finder.includes(filename, self._path):
+            return set()
+        return {filename}
+
+    def close(self):
+        """Stop watching"""
+        os.close(self._fd)
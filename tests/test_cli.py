@@ -8,7 +8,15 @@ from click.testing import CliRunner
 from magic_marker import cli
 from tests.helpers.ast_helpers import ClassDecoratorRetriever
 from tests.helpers.ast_helpers import FunctionDecoratorRetriever
+import subprocess
+import pytest
+import json
+import tarfile
+import pstats
+import hashlib
+import sys
 import re
+import os
 import ast
 
 
@@ -130,3 +138,545 @@ def test_stepped_class_workflow(stepped_class_workflow, stepped_class_config, mo
     assert "@pytest.mark.test_id('{}')".format(uuid_patch) in class_decorators['TestFooBar']
     for funct, decorators in list(function_decorators.items()):  # there should be no @pytest.mark on any function
         assert not decorators
+
+
+def test_ast_engine_mark_one(one_of_two_unmarked, original_behavior_config, uuid_patch, mocker):
+    """Test only marking one of two tests with the native AST engine"""
+
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+
+    runner = CliRunner()
+    cli_arguments = ["--config={}".format(original_behavior_config), "--engine=ast", one_of_two_unmarked.path]
+    result = runner.invoke(cli.main, args=cli_arguments)
+
+    assert result.exit_code == 0
+    assert "one_of_two_unmarked.py : 1 test mark added" in result.output
+    with open(one_of_two_unmarked.path, 'r') as f:
+        observed_data = f.read()
+    assert observed_data == one_of_two_unmarked.expected
+
+
+def test_ast_engine_stepped_class_workflow(stepped_class_workflow, stepped_class_config, uuid_patch, mocker):
+    """Test that the native AST engine honours the exclude options of a mark"""
+
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+
+    runner = CliRunner()
+    cli_arguments = ["--config={}".format(stepped_class_config), "--engine=ast", stepped_class_workflow.path]
+    result = runner.invoke(cli.main, args=cli_arguments)
+
+    assert result.exit_code == 0
+    assert "stepped_class_workflow.py : 4 test marks added" in result.output
+    with open(stepped_class_workflow.path, 'r') as f:
+        node = ast.parse(f.read(), mode='exec')
+    class_decorators = ClassDecoratorRetriever().visit(node)
+    function_decorators = FunctionDecoratorRetriever().visit(node)
+
+    assert '@pytest.mark.test_case_with_steps()' in class_decorators['TestBaz']
+    assert "@pytest.mark.test_id('{}')".format(uuid_patch) in class_decorators['TestBaz']
+    for funct, decorators in list(function_decorators.items()):
+        assert not decorators
+
+
+def test_parallel_jobs(one_test_unmarked, two_tests_unmarked, original_behavior_config, uuid_patch, mocker, tmpdir):
+    """Test that files fixed by a pool of workers are all fixed and summarised"""
+
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+    tmpdir.join('one_test_unmarked.py').write(one_test_unmarked.original)
+    tmpdir.join('two_tests_unmarked.py').write(two_tests_unmarked.original)
+
+    runner = CliRunner()
+    cli_arguments = ["--config={}".format(original_behavior_config), "--jobs=2", tmpdir.strpath]
+    result = runner.invoke(cli.main, args=cli_arguments)
+
+    assert result.exit_code == 0
+    assert "one_test_unmarked.py : 1 test mark added" in result.output
+    assert "two_tests_unmarked.py : 2 test marks added" in result.output
+    assert tmpdir.join('one_test_unmarked.py').read() == one_test_unmarked.expected
+    assert tmpdir.join('two_tests_unmarked.py').read() == two_tests_unmarked.expected
+
+
+def test_cache_skips_clean_files(none_unmarked, original_behavior_config, uuid_patch, mocker, tmpdir):
+    """Test that a file with nothing to fix is skipped until it changes"""
+
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+
+    runner = CliRunner()
+    cli_arguments = ["--config={}".format(original_behavior_config),
+                     "--cache",
+                     "--cache-dir={}".format(tmpdir.join('cache').strpath),
+                     none_unmarked.path]
+    result = runner.invoke(cli.main, args=cli_arguments)
+    assert result.exit_code == 0
+    assert "none_unmarked.py : 0 test marks added" in result.output
+
+    result = runner.invoke(cli.main, args=cli_arguments)
+    assert result.exit_code == 0
+    assert "none_unmarked.py" not in result.output
+
+    with open(none_unmarked.path, 'a') as f:
+        f.write("\ndef test_i_am_new():\n    pass\n")
+    result = runner.invoke(cli.main, args=cli_arguments)
+    assert result.exit_code == 0
+    assert "none_unmarked.py : 1 test mark added" in result.output
+
+
+@pytest.mark.parametrize('option', ['--engine=ast', '--cache', '--index', '--changed-since=HEAD'])
+def test_excluded_files_are_left_alone(option, one_test_unmarked, original_behavior_config, uuid_patch, mocker,
+                                       tmpdir):
+    """Test that files excluded by the flake8 config are not marked when the files are picked by Magic Marker"""
+
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+    git = ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com']
+    tree = tmpdir.mkdir('tree')
+    config = tree.join('tox.ini')
+    with open(original_behavior_config, 'r') as f:
+        config.write(f.read().replace('[flake8]\n', '[flake8]\nexclude = vendor\n'))
+    subprocess.check_call(git + ['init', '-q'], cwd=tree.strpath)
+    subprocess.check_call(git + ['add', '.'], cwd=tree.strpath)
+    subprocess.check_call(git + ['commit', '-q', '-m', 'initial'], cwd=tree.strpath)
+    tree.mkdir('t').join('test_t.py').write(one_test_unmarked.original)
+    tree.mkdir('vendor').join('test_v.py').write(one_test_unmarked.original)
+
+    cli_arguments = ["--config={}".format(config.strpath),
+                     "--cache-dir={}".format(tmpdir.join('cache').strpath),
+                     option,
+                     tree.strpath]
+    result = CliRunner().invoke(cli.main, args=cli_arguments)
+
+    assert result.exit_code == 0
+    assert "test_t.py : 1 test mark added" in result.output
+    assert "test_v.py" not in result.output
+    assert tree.join('t', 'test_t.py').read() == one_test_unmarked.expected
+    assert tree.join('vendor', 'test_v.py').read() == one_test_unmarked.original
+
+
+def test_changed_since(one_test_unmarked, two_tests_unmarked, original_behavior_config, uuid_patch, mocker, tmpdir):
+    """Test that only the files changed since a git ref are fixed and backed up"""
+
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+    git = ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com']
+    tmpdir.join('committed.py').write(one_test_unmarked.original)
+    tmpdir.join('modified.py').write(one_test_unmarked.original)
+    subprocess.check_call(git + ['init', '-q'], cwd=tmpdir.strpath)
+    subprocess.check_call(git + ['add', '.'], cwd=tmpdir.strpath)
+    subprocess.check_call(git + ['commit', '-q', '-m', 'initial'], cwd=tmpdir.strpath)
+    tmpdir.join('modified.py').write(two_tests_unmarked.original)
+    tmpdir.join('added.py').write(one_test_unmarked.original)
+
+    runner = CliRunner()
+    cli_arguments = ["--config={}".format(original_behavior_config), "--changed-since=HEAD", tmpdir.strpath]
+    result = runner.invoke(cli.main, args=cli_arguments)
+
+    assert result.exit_code == 0
+    assert "added.py : 1 test mark added" in result.output
+    assert "modified.py : 2 test marks added" in result.output
+    assert "committed.py" not in result.output
+    assert tmpdir.join('committed.py').read() == one_test_unmarked.original
+    backup_regex = re.compile('^A backup was created : (.*)$', re.MULTILINE)
+    backup_path = backup_regex.search(str(result.output)).group(1)
+    assert sorted(os.listdir(backup_path)) == ['added.py', 'manifest.json', 'modified.py']
+
+
+def test_selective_backup(one_test_unmarked, none_unmarked, original_behavior_config, tmpdir):
+    """Test that only the files about to be rewritten are backed up unless a full backup is requested"""
+
+    tmpdir.mkdir('sub').join('one_test_unmarked.py').write(one_test_unmarked.original)
+    tmpdir.join('none_unmarked.py').write(none_unmarked.original)
+    backup_regex = re.compile('^A backup was created : (.*)$', re.MULTILINE)
+
+    runner = CliRunner()
+    cli_arguments = ["--config={}".format(original_behavior_config), "--full-backup", tmpdir.strpath]
+    result = runner.invoke(cli.main, args=cli_arguments)
+    assert result.exit_code == 0
+    backup_path = backup_regex.search(str(result.output)).group(1)
+    assert sorted(os.listdir(backup_path)) == ['none_unmarked.py', 'sub']
+
+    tmpdir.join('sub', 'one_test_unmarked.py').write(one_test_unmarked.original)
+    cli_arguments = ["--config={}".format(original_behavior_config), tmpdir.strpath]
+    result = runner.invoke(cli.main, args=cli_arguments)
+    assert result.exit_code == 0
+    backup_path = backup_regex.search(str(result.output)).group(1)
+    assert sorted(os.listdir(backup_path)) == ['manifest.json', 'sub']
+    with open(os.path.join(backup_path, 'sub', 'one_test_unmarked.py'), 'r') as f:
+        assert f.read() == one_test_unmarked.original
+    with open(os.path.join(backup_path, 'manifest.json'), 'r') as f:
+        assert json.load(f)['files'] == [os.path.join('sub', 'one_test_unmarked.py')]
+
+
+def test_hardlink_backup(one_test_unmarked, none_unmarked, original_behavior_config, uuid_patch, mocker, tmpdir):
+    """Test that a hard linked backup is not modified when the linked files are fixed"""
+
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+    tmpdir.join('one_test_unmarked.py').write(one_test_unmarked.original)
+    tmpdir.join('none_unmarked.py').write(none_unmarked.original)
+
+    runner = CliRunner()
+    cli_arguments = ["--config={}".format(original_behavior_config),
+                     "--full-backup",
+                     "--backup-strategy=hardlink",
+                     tmpdir.strpath]
+    result = runner.invoke(cli.main, args=cli_arguments)
+
+    assert result.exit_code == 0
+    backup_path = re.search('^A backup was created : (.*)$', str(result.output), re.MULTILINE).group(1)
+    assert tmpdir.join('one_test_unmarked.py').read() == one_test_unmarked.expected
+    with open(os.path.join(backup_path, 'one_test_unmarked.py'), 'r') as f:
+        assert f.read() == one_test_unmarked.original
+    assert os.path.samefile(os.path.join(backup_path, 'none_unmarked.py'), tmpdir.join('none_unmarked.py').strpath)
+
+
+def test_archive_backup(one_test_unmarked, none_unmarked, original_behavior_config, tmpdir):
+    """Test that the files about to be rewritten are backed up into a compressed tar with a manifest next to it"""
+
+    tmpdir.join('one_test_unmarked.py').write(one_test_unmarked.original)
+    tmpdir.join('none_unmarked.py').write(none_unmarked.original)
+
+    runner = CliRunner()
+    cli_arguments = ["--config={}".format(original_behavior_config), "--backup-format=tar.xz", tmpdir.strpath]
+    result = runner.invoke(cli.main, args=cli_arguments)
+
+    assert result.exit_code == 0
+    backup_path = re.search('^A backup was created : (.*)$', str(result.output), re.MULTILINE).group(1)
+    assert backup_path.endswith('.tar.xz')
+    with tarfile.open(backup_path, 'r:xz') as archive:
+        assert archive.getnames() == ['one_test_unmarked.py']
+        backed_up = archive.extractfile('one_test_unmarked.py').read()
+    with open(backup_path + '.manifest.json', 'r') as f:
+        manifest = json.load(f)
+    assert backed_up.decode('utf-8') == one_test_unmarked.original
+    assert manifest['files'] == [{'path': 'one_test_unmarked.py',
+                                  'sha256': hashlib.sha256(backed_up).hexdigest(),
+                                  'size': len(backed_up)}]
+
+
+def test_backup_store(one_test_unmarked, two_tests_unmarked, original_behavior_config, tmpdir):
+    """Test that the backup store only keeps distinct content for the most recent runs"""
+
+    store = tmpdir.join('store')
+    target = tmpdir.mkdir('target').join('test_file.py')
+
+    def run(content):
+        target.write(content)
+        cli_arguments = ["--config={}".format(original_behavior_config),
+                         "--backup-format=store",
+                         "--backup-store={}".format(store.strpath),
+                         "--backup-keep-runs=2",
+                         target.strpath]
+        result = CliRunner().invoke(cli.main, args=cli_arguments)
+        assert result.exit_code == 0
+        return re.search('^A backup was created : (.*)$', str(result.output), re.MULTILINE).group(1)
+
+    def blobs():
+        return sorted(name for root, dirs, files in os.walk(store.join('blobs').strpath) for name in files)
+
+    run(one_test_unmarked.original)
+    manifest_path = run(one_test_unmarked.original)
+    assert len(store.join('runs').listdir()) == 2
+    assert len(blobs()) == 1
+    with open(manifest_path, 'r') as f:
+        digest = json.load(f)['files'][0]['sha256']
+    assert blobs() == [digest]
+
+    run(two_tests_unmarked.original)
+    run(two_tests_unmarked.original + '\n')
+    assert len(store.join('runs').listdir()) == 2
+    assert len(blobs()) == 2
+    assert digest not in blobs()
+
+
+def test_check_ids(original_behavior_config, uuid_patch, mocker, tmpdir):
+    """Test that a minted ID never collides with an ID that is already in the target"""
+
+    fresh = '0c4fbd6e-1c1e-11eb-9f2f-0242ac130002'
+    mocker.patch('uuid.uuid1', side_effect=[uuid_patch, fresh])
+    marked = tmpdir.join('test_marked.py')
+    unmarked = tmpdir.join('test_unmarked.py')
+    marked.write("@pytest.mark.test_id('{}')\ndef test_one():\n    pass\n".format(uuid_patch))
+    unmarked.write("def test_two():\n    pass\n")
+
+    cli_arguments = ["--config={}".format(original_behavior_config), "--check-ids", tmpdir.strpath]
+    result = CliRunner().invoke(cli.main, args=cli_arguments)
+
+    assert result.exit_code == 0
+    assert "test_unmarked.py : 1 test mark added" in result.output
+    assert "Duplicate" not in result.output
+    assert unmarked.read() == "@pytest.mark.test_id('{}')\ndef test_two():\n    pass\n".format(fresh)
+
+
+@pytest.mark.parametrize('strategy', ['copy', 'hardlink'])
+def test_fix_duplicate_ids(strategy, original_behavior_config, uuid_patch, mocker, tmpdir):
+    """Test that every duplicated ID but the first is reported and replaced, keeping the original in the backup"""
+
+    fresh = '0c4fbd6e-1c1e-11eb-9f2f-0242ac130002'
+    added = '1b2c3d4e-1c1e-11eb-9f2f-0242ac130002'
+    mocker.patch('uuid.uuid1', side_effect=[fresh, added])
+    first = tmpdir.join('test_first.py')
+    second = tmpdir.join('test_second.py')
+    first.write("@pytest.mark.test_id('{}')\ndef test_one():\n    pass\n".format(uuid_patch))
+    second_original = ("@pytest.mark.test_id('{}')\ndef test_two():\n    pass\n\n\n"
+                       "def test_three():\n    pass\n".format(uuid_patch))
+    second.write(second_original)
+
+    cli_arguments = ["--config={}".format(original_behavior_config),
+                     "--fix-duplicate-ids",
+                     "--backup-strategy={}".format(strategy),
+                     tmpdir.strpath]
+    result = CliRunner().invoke(cli.main, args=cli_arguments)
+
+    assert result.exit_code == 0
+    assert "Duplicate test_id '{}' replaced : {}:1, {}:1".format(uuid_patch, first, second) in result.output
+    assert first.read() == "@pytest.mark.test_id('{}')\ndef test_one():\n    pass\n".format(uuid_patch)
+    assert second.read() == ("@pytest.mark.test_id('{}')\ndef test_two():\n    pass\n\n\n"
+                             "@pytest.mark.test_id('{}')\ndef test_three():\n    pass\n".format(fresh, added))
+    backup = re.search('^A backup was created : (.*)$', str(result.output), re.MULTILINE).group(1)
+    with open(os.path.join(backup, 'test_second.py'), 'r') as f:
+        assert f.read() == second_original
+    with open(os.path.join(backup, 'manifest.json'), 'r') as f:
+        assert json.load(f)['files'] == ['test_second.py']
+
+
+def test_fix_duplicate_ids_with_full_backup_of_changed_files(original_behavior_config, uuid_patch, mocker, tmpdir):
+    """Test that a file outside of the files targeted is backed up before its duplicated ID is replaced"""
+
+    mocker.patch('uuid.uuid1', side_effect=['0c4fbd6e-1c1e-11eb-9f2f-0242ac130002',
+                                            '1b2c3d4e-1c1e-11eb-9f2f-0242ac130002'])
+    git = ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com']
+    marked = "@pytest.mark.test_id('{}')\ndef test_one():\n    pass\n".format(uuid_patch)
+    tmpdir.join('test_old1.py').write(marked)
+    tmpdir.join('test_old2.py').write(marked)
+    subprocess.check_call(git + ['init', '-q'], cwd=tmpdir.strpath)
+    subprocess.check_call(git + ['add', '.'], cwd=tmpdir.strpath)
+    subprocess.check_call(git + ['commit', '-q', '-m', 'initial'], cwd=tmpdir.strpath)
+    tmpdir.join('test_new.py').write("def test_two():\n    pass\n")
+
+    cli_arguments = ["--config={}".format(original_behavior_config),
+                     "--full-backup",
+                     "--fix-duplicate-ids",
+                     "--changed-since=HEAD",
+                     tmpdir.strpath]
+    result = CliRunner().invoke(cli.main, args=cli_arguments)
+
+    assert result.exit_code == 0
+    assert "Duplicate test_id '{}' replaced".format(uuid_patch) in result.output
+    assert tmpdir.join('test_old2.py').read() != marked
+    backup = re.search('^A backup was created : (.*)$', str(result.output), re.MULTILINE).group(1)
+    assert sorted(os.listdir(backup)) == ['manifest.json', 'test_new.py', 'test_old2.py']
+    with open(os.path.join(backup, 'test_old2.py'), 'r') as f:
+        assert f.read() == marked
+
+
+def test_index(original_behavior_config, uuid_patch, tmpdir):
+    """Test indexing a tree, querying it and updating it incrementally"""
+
+    marked = tmpdir.join('test_marked.py')
+    unmarked = tmpdir.join('test_unmarked.py')
+    marked.write("class TestFoo(object):\n\n"
+                 "    @pytest.mark.test_id('{}')\n"
+                 "    @pytest.mark.jira('ASC-1')\n"
+                 "    def test_one(self):\n"
+                 "        pass\n".format(uuid_patch))
+    unmarked.write("def test_two():\n    pass\n\n\ndef test_three():\n    pass\n")
+    cli_arguments = ["index",
+                     "--config={}".format(original_behavior_config),
+                     "--cache-dir={}".format(tmpdir.join('cache').strpath),
+                     "--find={}".format(uuid_patch),
+                     "--unmarked",
+                     tmpdir.strpath]
+
+    result = CliRunner().invoke(cli.main, args=cli_arguments)
+    assert result.exit_code == 0
+    assert "2 files indexed, 2 of them updated" in result.output
+    assert "{}:3 TestFoo.test_one (test_id)".format(marked) in result.output
+    assert "2 unmarked tests under" in result.output
+
+    unmarked.write("@pytest.mark.test_id('{}')\n@pytest.mark.jira('ASC-2')\ndef test_two():\n    pass\n"
+                   .format(uuid_patch))
+    result = CliRunner().invoke(cli.main, args=cli_arguments)
+    assert result.exit_code == 0
+    assert "2 files indexed, 1 of them updated" in result.output
+    assert "{}:1 test_two (test_id)".format(unmarked) in result.output
+    assert "0 unmarked tests under" in result.output
+
+
+def test_commands(one_test_unmarked, original_behavior_config, uuid_patch, mocker, monkeypatch, tmpdir):
+    """Test that help reaches the group, mark lists the other commands and a path named like a command can be marked"""
+
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+    for help_option in ('--help', '-h'):
+        result = CliRunner().invoke(cli.main, args=[help_option])
+        assert result.exit_code == 0
+        assert all(command in result.output for command in ('mark', 'index', 'pre-commit', 'serve'))
+    result = CliRunner().invoke(cli.main, args=['mark', '--help'])
+    assert result.exit_code == 0
+    assert all(command in result.output for command in ('index', 'pre-commit', 'serve'))
+
+    tmpdir.mkdir('index').join('test_file.py').write(one_test_unmarked.original)
+    monkeypatch.chdir(tmpdir.strpath)
+    result = CliRunner().invoke(cli.main, args=['index', '--help'])
+    assert "pass './index' to mark the path" in result.stderr
+    assert "Index the tests under a path" in result.stdout
+    result = CliRunner().invoke(cli.main, args=["--config={}".format(original_behavior_config), './index'])
+    assert result.exit_code == 0
+    assert tmpdir.join('index', 'test_file.py').read() == one_test_unmarked.expected
+
+
+def test_startup_is_lazy():
+    """Test that starting the CLI loads none of the modules that are only needed once work is under way"""
+
+    code = "import magic_marker.cli, sys; print(' '.join(sorted(sys.modules)))"
+    modules = subprocess.check_output([sys.executable, '-c', code]).decode('utf-8').split()
+    heavy = ('flake8', 'flake8_pytest_mark', 'pycodestyle', 'pyflakes', 'multiprocessing', 'tarfile', 'subprocess')
+
+    assert [m for m in modules if m.split('.')[0] in heavy] == []
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="-X importtime is only available from python 3.7")
+def test_startup_time():
+    """Test that importing the CLI stays within a generous time budget"""
+
+    budget = 0.25  # seconds, roughly three times the measured cost so only a heavy import sneaking back in fails
+    output = subprocess.check_output([sys.executable, '-X', 'importtime', '-c', 'import magic_marker.cli'],
+                                     stderr=subprocess.STDOUT).decode('utf-8')
+    lines = [line for line in output.splitlines() if line.rstrip().endswith(' magic_marker.cli')]
+    cumulative = [int(line.split('|')[1]) for line in lines]
+
+    assert cumulative and cumulative[0] / 1e6 < budget
+
+
+def test_pre_commit(one_test_unmarked, none_unmarked, original_behavior_config, uuid_patch, mocker):
+    """Test that only the files given are marked and that the hook fails while it changes files"""
+
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+    check = mocker.spy(cli.MagicMarker, 'run_flake8_and_mark')
+    cli_arguments = ["pre-commit",
+                     "--config={}".format(original_behavior_config),
+                     one_test_unmarked.path,
+                     none_unmarked.path]
+
+    result = CliRunner().invoke(cli.main, args=cli_arguments)
+    assert result.exit_code == 1
+    assert "one_test_unmarked.py : 1 test mark added" in result.output
+    assert check.call_args[1]['files'] == [one_test_unmarked.path, none_unmarked.path]
+    backup = re.search('^A backup was created : (.*)$', str(result.output), re.MULTILINE).group(1)
+    with open(os.path.join(backup, 'manifest.json'), 'r') as f:
+        backed_up = json.load(f)['files']
+    assert len(backed_up) == 1 and backed_up[0].endswith('one_test_unmarked.py')
+    with open(one_test_unmarked.path, 'r') as f:
+        assert f.read() == one_test_unmarked.expected
+
+    result = CliRunner().invoke(cli.main, args=cli_arguments)
+    assert result.exit_code == 0
+    assert result.output == ''
+
+
+def test_diff(one_test_unmarked, original_behavior_config, uuid_patch, mocker):
+    """Test that --check and --diff write nothing, make no backup and print the marks that would be added"""
+
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+    with open(one_test_unmarked.path, 'r') as f:
+        original = f.read()
+    make_backup = mocker.spy(cli.MagicMarker, '_make_backup')
+
+    result = CliRunner().invoke(cli.main, args=["--config={}".format(original_behavior_config),
+                                                "--diff",
+                                                "--check",
+                                                one_test_unmarked.path])
+    assert result.exit_code == 1
+    assert "+++ b/{}".format(os.path.relpath(one_test_unmarked.path).replace(os.sep, '/')) in result.output
+    assert "+@pytest.mark.test_id('{}')".format(uuid_patch) in result.output
+    assert "one_test_unmarked.py : 1 test mark would be added" in result.output
+    assert "backup" not in result.output
+    assert not make_backup.called
+    with open(one_test_unmarked.path, 'r') as f:
+        assert f.read() == original
+
+    result = CliRunner().invoke(cli.main, args=["--config={}".format(original_behavior_config),
+                                                "--check",
+                                                one_test_unmarked.path])
+    assert result.exit_code == 1
+    assert "+++" not in result.output
+
+
+def test_diff_applies(one_test_unmarked, original_behavior_config, uuid_patch, mocker, monkeypatch, tmpdir):
+    """Test that the diff printed by --diff applies with git apply"""
+
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+    tmpdir.mkdir('tests').join('test_file.py').write(one_test_unmarked.original)
+    monkeypatch.chdir(tmpdir.strpath)
+
+    result = CliRunner().invoke(cli.main, args=["--config={}".format(original_behavior_config), "--diff", "tests"])
+    assert result.exit_code == 0
+    assert tmpdir.join('tests', 'test_file.py').read() == one_test_unmarked.original
+
+    apply = subprocess.Popen(['git', 'apply'], stdin=subprocess.PIPE, cwd=tmpdir.strpath)
+    apply.communicate(result.stdout.encode('utf-8'))
+    assert apply.returncode == 0
+    assert tmpdir.join('tests', 'test_file.py').read() == one_test_unmarked.expected
+
+
+def test_report(one_test_unmarked, original_behavior_config, uuid_patch, mocker, tmpdir):
+    """Test that --report writes the structured record of the run as JSON or JSON Lines"""
+
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+    report_path = tmpdir.join('report.jsonl').strpath
+
+    result = CliRunner().invoke(cli.main, args=["--config={}".format(original_behavior_config),
+                                                "--diff",
+                                                "--report={}".format(report_path),
+                                                "--report-format=jsonl",
+                                                one_test_unmarked.path])
+    assert result.exit_code == 0
+    with open(report_path, 'r') as f:
+        records = [json.loads(line) for line in f]
+    assert records[0] == {'type': 'mark', 'filename': one_test_unmarked.path, 'line': 13,
+                          'mark': 'test_id', 'value': uuid_patch}
+    assert records[-1]['type'] == 'summary'
+    assert records[-1]['marks_added'] == 1 and records[-1]['dry_run'] and records[-1]['backup'] is None
+
+    result = CliRunner().invoke(cli.main, args=["--config={}".format(original_behavior_config),
+                                                "--report=-",
+                                                one_test_unmarked.path])
+    assert result.exit_code == 0
+    report = json.loads(result.stdout)
+    assert report['marks_added'] == 1 and os.path.exists(report['backup'])
+    assert report['files'][0]['marks'] == [{'line': 13, 'mark': 'test_id', 'value': uuid_patch}]
+    assert "Success!" in result.stderr
+
+
+def test_profile(one_test_unmarked, original_behavior_config, uuid_patch, mocker, tmpdir):
+    """Test that --profile saves statistics pstats can read and prints the timings"""
+
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+    profile_path = tmpdir.join('out.prof').strpath
+
+    result = CliRunner().invoke(cli.main, args=["--config={}".format(original_behavior_config),
+                                                "--profile={}".format(profile_path),
+                                                one_test_unmarked.path])
+
+    assert result.exit_code == 0
+    assert re.search(r'^detect\s+\d+\.\d{3}', result.output, re.MULTILINE)
+    assert re.search(r'^marks added\s+1$', result.output, re.MULTILINE)
+    assert pstats.Stats(profile_path).total_calls > 0
+
+
+def test_archive_backup_with_workers(original_behavior_config, uuid_patch, mocker, tmpdir):
+    """Test that files fixed by worker processes are backed up into an archive held by the parent process"""
+
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+    names = ['test_{}.py'.format(number) for number in range(3)]
+    for name in names:
+        tmpdir.join(name).write("def test_one():\n    pass\n")
+
+    result = CliRunner().invoke(cli.main, args=["--config={}".format(original_behavior_config),
+                                                "--jobs=2",
+                                                "--backup-format=tar.gz",
+                                                tmpdir.strpath])
+
+    assert result.exit_code == 0
+    for name in names:
+        assert tmpdir.join(name).read() == "@pytest.mark.test_id('{}')\ndef test_one():\n    pass\n".format(uuid_patch)
+    backup = re.search('^A backup was created : (.*)$', str(result.output), re.MULTILINE).group(1)
+    with tarfile.open(backup, 'r:gz') as archive:
+        assert sorted(archive.getnames()) == names
+        assert archive.extractfile(names[0]).read() == b"def test_one():\n    pass\n"
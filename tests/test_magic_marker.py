@@ -0,0 +1,569 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# ======================================================================================================================
+# Imports
+# ======================================================================================================================
+from magic_marker.magic_marker import MagicMarker
+from magic_marker.backup import ArchiveBackup, BackupStore, StoreBackup
+from magic_marker.index import MarkIndex
+from magic_marker.detector import AstDetector, FileFinder
+from magic_marker.fixable import Fixable
+from magic_marker.fixes import FixStrategy
+import magic_marker.fixable
+from magic_marker.watch import PollingWatcher, InotifyWatcher
+from magic_marker import client
+from benchmarks.synthetic import TreeShape, make_tree
+from benchmarks import run as benchmarks
+import magic_marker.magic_marker
+import magic_marker.watch
+from flake8.main.application import Application
+import threading
+import tarfile
+import pytest
+import stat
+import time
+import sys
+import os
+
+
+def test_rewrite_is_atomic(one_test_unmarked, uuid_patch, mocker):
+    """Test that a file is replaced by the fixed copy, keeping its permissions"""
+
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+    os.chmod(one_test_unmarked.path, 0o640)
+    mm = MagicMarker(jobs=1)
+    mm.options = {'pytest_mark1': {'name': 'test_id', 'value_match': 'uuid'}}
+
+    file_report = mm._fix_file([{'filename': one_test_unmarked.path, 'line_number': 13, 'code': 'M501'}])
+
+    assert file_report.count == 1
+    with open(one_test_unmarked.path, 'r') as f:
+        assert f.read() == one_test_unmarked.expected
+    assert stat.S_IMODE(os.stat(one_test_unmarked.path).st_mode) == 0o640
+    assert os.listdir(os.path.dirname(one_test_unmarked.path)) == ['one_test_unmarked.py']
+
+
+def test_splice_marks_above_decorators():
+    """Test that marks go above the decorators of a definition, holding back no more than its decorators"""
+
+    source = ['def helper():\n',
+              '    """\n',
+              '@not_a_decorator\n',
+              '    """\n',
+              '\n',
+              '\n',
+              'class TestFoo(object):\n',
+              '\n',
+              '    @pytest.mark.parametrize(\n',
+              '        "value", ["@", ")"]\n',
+              '    )\n',
+              '    # a comment\n',
+              '    @pytest.mark.jira("ASC-1")\n',
+              '    def test_one(self, value):\n',
+              '        pass\n']
+    read = []
+
+    def lines():
+        for line in source:
+            read.append(line)
+            yield line
+
+    spliced = MagicMarker._splice(lines(), {2: ["@pytest.mark.foo()\n"], 13: ["@pytest.mark.test_id('x')\n"]})
+
+    assert next(spliced) == source[0]
+    assert next(spliced) == source[1]
+    assert next(spliced) == "@pytest.mark.foo()\n"
+    assert [next(spliced) for _ in range(6)] == source[2:8]
+    assert len(read) == 8
+    assert next(spliced) == "    @pytest.mark.test_id('x')\n"
+    assert len(read) == 14
+    assert list(spliced) == source[8:]
+
+
+def test_rewrite_follows_symlinks(one_test_unmarked, uuid_patch, mocker, tmpdir):
+    """Test that fixing a symbolic link rewrites the file it points to and leaves the link in place"""
+
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+    link = tmpdir.mkdir('links').join('test_link.py').strpath
+    os.symlink(one_test_unmarked.path, link)
+    mm = MagicMarker(jobs=1)
+    mm.options = {'pytest_mark1': {'name': 'test_id', 'value_match': 'uuid'}}
+
+    file_report = mm._fix_file([{'filename': link, 'line_number': 13, 'code': 'M501'}])
+
+    assert file_report.count == 1
+    assert os.path.islink(link) and os.readlink(link) == one_test_unmarked.path
+    with open(one_test_unmarked.path, 'r') as f:
+        assert f.read() == one_test_unmarked.expected
+    assert os.listdir(os.path.dirname(link)) == ['test_link.py']
+
+
+def test_failed_rewrite_keeps_original(one_test_unmarked):
+    """Test that a rewrite that fails part way leaves the original untouched"""
+
+    mm = MagicMarker(jobs=1)
+    mm.options = {'pytest_mark1': {'name': 'test_id', 'value_match': 'uuid'}}
+
+    with pytest.raises(RuntimeError):
+        mm._fix_file([{'filename': one_test_unmarked.path, 'line_number': 500, 'code': 'M501'}])
+
+    with open(one_test_unmarked.path, 'r') as f:
+        assert f.read() == one_test_unmarked.original
+    assert os.listdir(os.path.dirname(one_test_unmarked.path)) == ['one_test_unmarked.py']
+
+
+@pytest.mark.parametrize('error', [KeyboardInterrupt, UnicodeDecodeError('utf-8', b'\xff', 0, 1, 'invalid')])
+def test_interrupted_rewrite_leaves_no_temp_file(error, one_test_unmarked, mocker):
+    """Test that the temp file of a rewrite is removed whatever stops it, the original is left untouched"""
+
+    mm = MagicMarker(jobs=1)
+    mocker.patch.object(MagicMarker, '_splice', side_effect=error)
+
+    with pytest.raises((KeyboardInterrupt, UnicodeDecodeError)):
+        mm._rewrite_file(one_test_unmarked.path, {12: ['@pytest.mark.test_id()\n']})
+
+    with open(one_test_unmarked.path, 'r') as f:
+        assert f.read() == one_test_unmarked.original
+    assert os.listdir(os.path.dirname(one_test_unmarked.path)) == ['one_test_unmarked.py']
+
+
+def test_find_options_memoized(original_behavior_config, mocker, tmpdir):
+    """Test that flake8 is only initialized again once the config file changes"""
+
+    cache_dir = tmpdir.join('cache').strpath
+    spy = mocker.spy(MagicMarker, '_load_options')
+
+    MagicMarker(cache_dir=cache_dir).find_options(original_behavior_config)
+    magic_marker.magic_marker._options_cache.clear()  # a new process only has the cache on disk
+    mm = MagicMarker(cache_dir=cache_dir)
+    mm.find_options(original_behavior_config)
+    assert spy.call_count == 1
+    assert mm.options['pytest_mark1']['name'] == 'test_id'
+
+    with open(original_behavior_config, 'a') as f:
+        f.write("\npytest_mark3 = name=owner\n")
+    mm.find_options(original_behavior_config)
+    assert spy.call_count == 2
+    assert mm.options['pytest_mark3'] == {'name': 'owner'}
+
+
+def test_engines_agree(one_of_two_unmarked, original_behavior_config, tmpdir):
+    """Test that the native detector reports the same violations as flake8 for decorated tests"""
+
+    methods = tmpdir.join('test_methods.py')
+    methods.write("class TestFoo(object):\n\n"
+                  "    @pytest.mark.foo('bar')\n"
+                  "    @pytest.mark.jira('ASC-1')\n"
+                  "    def test_one(self):\n"
+                  "        pass\n")
+    mm = MagicMarker(jobs=1)
+    mm.find_options(original_behavior_config)
+    from_flake8 = {}
+
+    def on_file(filename, violations):
+        from_flake8[filename] = violations
+
+    mm._flake8_engine(original_behavior_config).check([one_of_two_unmarked.path, methods.strpath], on_file)
+
+    def summary(violations):
+        return sorted((v['line_number'], v['code'], v['text']) for v in violations)
+
+    detector = AstDetector(mm.options)
+    for filename in (one_of_two_unmarked.path, methods.strpath):
+        assert summary(detector.check_file(filename)) == summary(from_flake8[filename])
+    assert summary(from_flake8[methods.strpath]) == [(5, 'M501', 'test definition not marked with test_id')]
+
+
+def test_one_flake8_application(two_tests_unmarked, original_behavior_config, uuid_patch, mocker):
+    """Test that a run loads flake8 once and leaves the sys globals alone"""
+
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+    spy = mocker.spy(Application, 'initialize')
+    argv, stdout = sys.argv, sys.stdout
+
+    message = MagicMarker(jobs=1).run_flake8_and_mark(two_tests_unmarked.path, original_behavior_config)
+
+    assert "two_tests_unmarked.py : 2 test marks added" in message
+    assert spy.call_count == 1
+    assert sys.argv is argv and sys.stdout is stdout
+
+
+def test_report(two_tests_unmarked, original_behavior_config, uuid_patch, mocker):
+    """Test that a run records every mark added and every violation left alone, and renders the message from it"""
+
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+    mm = MagicMarker(jobs=1)
+
+    message = mm.run_flake8_and_mark(two_tests_unmarked.path, original_behavior_config)
+
+    report = mm.report
+    assert message == report.message()
+    assert report.marks_added == 2
+    assert report.backup == mm.backup_path
+    assert [f.filename for f in report.files] == [two_tests_unmarked.path]
+    assert report.files[0].marks == [{'line': 13, 'mark': 'test_id', 'value': uuid_patch},
+                                     {'line': 17, 'mark': 'test_id', 'value': uuid_patch}]
+    assert [(v['line'], v['code']) for v in report.files[0].skipped] == [(13, 'M502'), (17, 'M502')]
+    records = list(report.iter_records())
+    assert [r['type'] for r in records] == ['mark', 'mark', 'skipped', 'skipped', 'summary']
+    assert records[-1]['marks_added'] == 2
+
+
+def test_timings(two_tests_unmarked, original_behavior_config, uuid_patch, mocker):
+    """Test that the phases of a run exclude the phases nested in them and are passed to the hooks as they end"""
+
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+    ended = []
+    mm = MagicMarker(engine='ast', jobs=1)
+    mm.add_timing_hook(lambda name, seconds: ended.append(name))
+
+    mm.run_flake8_and_mark(two_tests_unmarked.path, original_behavior_config)
+
+    timings = mm.timings
+    assert timings.phases[:2] == ['options', 'discover']
+    assert set(['backup', 'detect', 'fix']) <= set(timings.phases)
+    assert set(ended) == set(timings.phases)
+    assert abs(timings.total - sum(timings.seconds[name] for name in timings.phases)) < 1e-9
+    assert timings.counts == {'files checked': 1, 'violations': 4, 'files fixed': 1, 'marks added': 2}
+    assert list(timings.file_seconds) == [two_tests_unmarked.path]
+    assert sum(files for label, files in timings.histogram()) == 1
+    assert 'detect' in timings.table()
+
+
+def test_each_run_has_its_own_backup(original_behavior_config, uuid_patch, mocker, tmpdir):
+    """Test that runs of the same MagicMarker never write into the backup of an earlier run"""
+
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+    tree = tmpdir.mkdir('tree')
+    for name in ('test_a.py', 'test_b.py', 'test_c.py'):
+        tree.join(name).write("def test_one():\n    pass\n")
+    mm = MagicMarker(jobs=1, backup_format='tar.gz')
+
+    mm.run_flake8_and_mark(tree.strpath, original_behavior_config, files=[tree.join('test_a.py').strpath])
+    first = mm.report.backup
+    mm.run_flake8_and_mark(tree.strpath, original_behavior_config, files=[tree.join('test_b.py').strpath])
+    second = mm.report.backup
+    third = tree.join('test_c.py').strpath
+    mm.fix_it({third: [{'filename': third, 'line_number': 1, 'code': 'M501', 'text': ''}]})
+
+    assert first and second and first != second
+    for backup, name in ((first, 'test_a.py'), (second, 'test_b.py')):
+        with tarfile.open(backup, 'r:gz') as archive:
+            assert archive.getnames() == [name]
+    assert mm.report.backup is None and mm.report.marks_added == 1
+
+
+def test_ids_from_index(original_behavior_config, mocker, tmpdir):
+    """Test that IDs are looked up in an index kept across runs, only the files changed since are parsed again"""
+
+    duplicated = '0c4fbd6e-1c1e-11eb-9f2f-0242ac130002'
+    mocker.patch('uuid.uuid1', side_effect=['1b2c3d4e-1c1e-11eb-9f2f-0242ac130002',
+                                            '2a3b4c5d-1c1e-11eb-9f2f-0242ac130002'])
+    index_file = mocker.spy(MarkIndex, '_index_file')
+    tree = tmpdir.mkdir('tree')
+    for name in ('test_a.py', 'test_b.py'):
+        tree.join(name).write("@pytest.mark.test_id('{}')\ndef test_one():\n    pass\n".format(duplicated))
+    tree.join('test_c.py').write("def test_one():\n    pass\n")
+    mm = MagicMarker(jobs=1, check_ids=True)
+
+    mm.run_flake8_and_mark(tree.strpath, original_behavior_config)
+    assert index_file.call_count == 3
+    assert [(mark, value) for mark, value, locations in mm.report.duplicates] == [('test_id', duplicated)]
+
+    tree.join('test_d.py').write("def test_one():\n    pass\n")
+    mm.run_flake8_and_mark(tree.strpath, original_behavior_config, files=[tree.join('test_d.py').strpath])
+    assert index_file.call_count == 5  # test_c.py was marked by the first run
+    assert [(mark, value) for mark, value, locations in mm.report.duplicates] == [('test_id', duplicated)]
+    assert "1b2c3d4e" in tree.join('test_c.py').read() and "2a3b4c5d" in tree.join('test_d.py').read()
+
+
+def test_archive_retention(tmpdir):
+    """Test that only the most recent archives are kept, leaving alone the files that are not archive backups"""
+
+    target = tmpdir.mkdir('target')
+    target.join('test_a.py').write('a')
+    backups = tmpdir.mkdir('backups')
+    backups.join('other.tar.gz').write('not a backup')
+    archives = []
+    for name in ('first', 'second', 'third'):
+        backup = ArchiveBackup(backups.join(name + '.tar.gz').strpath, target.strpath, keep_runs=2)
+        backup.add(target.join('test_a.py').strpath)
+        backup.close()
+        archives.append(backup)
+
+    kept = ['other.tar.gz', 'second.tar.gz', 'second.tar.gz.manifest.json',
+            'third.tar.gz', 'third.tar.gz.manifest.json']
+    assert sorted(path.basename for path in backups.listdir()) == kept
+    archives[-1].max_size = os.path.getsize(archives[-1].backup_path)
+    assert archives[-1].collect() == 1
+    assert not backups.join('second.tar.gz').exists() and backups.join('third.tar.gz').exists()
+
+
+def test_backup_store_spares_runs_in_progress(tmpdir):
+    """Test that collecting the backup store never deletes the blobs of a run that has not written its manifest yet"""
+
+    store = BackupStore(tmpdir.join('store').strpath, keep_runs=1)
+    target = tmpdir.mkdir('target')
+    target.join('test_a.py').write('a')
+    target.join('test_b.py').write('b')
+    in_progress = StoreBackup(target.strpath, store, 'in_progress')
+    in_progress.add(target.join('test_a.py').strpath)
+    finished = StoreBackup(target.strpath, store, 'finished')
+    finished.add(target.join('test_b.py').strpath)
+    finished.close()
+
+    def blobs():
+        return sorted(name for root, dirs, files in os.walk(tmpdir.join('store', 'blobs').strpath) for name in files)
+
+    assert len(blobs()) == 2
+    in_progress.close()
+    assert len(store.runs()) == 1
+    assert blobs() == [in_progress._manifest[0]['sha256']]
+
+
+def test_fix_it_skips_indexed_files(none_unmarked, tmpdir):
+    """Test that fix_it leaves alone the files the index knows are fully marked"""
+
+    options = {'pytest_mark1': {'name': 'test_id', 'value_match': 'uuid'}}
+    index_dir = tmpdir.join('index').strpath
+    mark_index = MarkIndex(index_dir, options)
+    mark_index.update(none_unmarked.path)
+    mark_index.close()
+    mm = MagicMarker(jobs=1, index_dir=index_dir)
+    mm.options = options
+
+    message = mm.fix_it({none_unmarked.path: [{'filename': none_unmarked.path, 'line_number': 13, 'code': 'M501'}]})
+
+    assert message is None
+    with open(none_unmarked.path, 'r') as f:
+        assert f.read() == none_unmarked.original
+
+
+def test_fixable_table(monkeypatch):
+    """Test that the fix of each mark comes from the compiled table, with the fix option taking precedence"""
+
+    options = {'pytest_mark1': {'name': 'test_id', 'value_match': 'uuid'},
+               'pytest_mark2': {'name': 'test_case_with_steps'},
+               'pytest_mark3': {'name': 'suite', 'fix': 'empty_value'},
+               'pytest_mark10': {'name': 'test_case_with_steps', 'fix': 'none'},
+               'pytest_mark11': {'name': 'jira'}}
+    fixable = Fixable()
+
+    assert fixable.check({'code': 'M501'}, options) == ('test_id', Fixable.fixes['uuid'])
+    assert fixable.check({'code': 'M502'}, options) == ('test_case_with_steps', Fixable.fixes['empty_value'])
+    assert fixable.check({'code': 'M503'}, options) == ('suite', Fixable.fixes['empty_value'])
+    assert fixable.check({'code': 'M510'}, options) == (None, None)
+    assert fixable.check({'code': 'M511'}, options) == (None, None)
+    monkeypatch.setitem(Fixable.default_fixes, 'jira', 'empty_value')
+    assert Fixable.compile(options)['M511'] == ('jira', Fixable.fixes['empty_value'])
+    with pytest.raises(RuntimeError):
+        fixable.load({'pytest_mark1': {'name': 'owner', 'fix': 'guess'}})
+
+
+class TicketFix(FixStrategy):
+    """A fix plug-in handing out ticket numbers"""
+
+    def __init__(self):
+        self.batches = []
+
+    def values(self, mark_name, count):
+        self.batches.append(count)
+        return ['ASC-{}'.format(n) for n in range(1, count + 1)]
+
+
+def test_fix_plugin(two_tests_unmarked, mocker):
+    """Test that a fix plug-in is only loaded once a mark refers to it, and generates its values in a batch"""
+
+    entry_point = mocker.Mock()
+    entry_point.load.return_value = TicketFix
+    iter_entry_points = mocker.patch('magic_marker.fixable._iter_entry_points', return_value=[entry_point])
+    mocker.patch.dict(magic_marker.fixable._plugins, clear=True)
+    mm = MagicMarker(jobs=1)
+
+    mm.options = {'pytest_mark1': {'name': 'test_id', 'value_match': 'uuid'}}
+    mm._fixable.load(mm.options)
+    assert not iter_entry_points.called
+
+    mm.options = {'pytest_mark1': {'name': 'jira', 'value_match': 'ticket'}}
+    file_report = mm._fix_file([{'filename': two_tests_unmarked.path, 'line_number': 13, 'code': 'M501'},
+                                {'filename': two_tests_unmarked.path, 'line_number': 17, 'code': 'M501'}])
+
+    assert file_report.count == 2
+    iter_entry_points.assert_called_once_with('ticket')
+    assert mm._fixable.check({'code': 'M501'}, mm.options)[1].batches == [2]
+    expected = two_tests_unmarked.original
+    expected = expected.replace("def test_i_am_not", "@pytest.mark.jira('ASC-1')\ndef test_i_am_not")
+    expected = expected.replace("def test_i_am_also", "@pytest.mark.jira('ASC-2')\ndef test_i_am_also")
+    with open(two_tests_unmarked.path, 'r') as f:
+        assert f.read() == expected
+
+
+def test_file_finder(tmpdir):
+    """Test that files are picked by the exclude and filename patterns of flake8, walking the tree or not"""
+
+    names = ('test_a.py', 'notes.txt', os.path.join('vendor', 'test_v.py'), os.path.join('sub', 'test_b.py'),
+             os.path.join('sub', 'gen', 'test_c.py'), os.path.join('sub', 'test_d.pyi'))
+    paths = [tmpdir.join(name).ensure().strpath for name in names]
+    finder = FileFinder(exclude=['vendor', tmpdir.join('sub', 'gen').strpath], filename=['*.py', '*.pyi'])
+
+    assert list(finder.iter_files(tmpdir.strpath)) == [paths[0], paths[3], paths[5]]
+    assert [f for f in paths if finder.includes(f, tmpdir.strpath)] == [paths[0], paths[3], paths[5]]
+    assert list(finder.iter_files(paths[1])) == [paths[1]]  # as flake8 checks any file it is given
+    assert FileFinder(**finder.to_dict()).to_dict() == finder.to_dict()
+
+    watcher = PollingWatcher(tmpdir.strpath, file_finder=finder)
+    tmpdir.join('vendor', 'test_v.py').write("def test_v():\n    pass\n")
+    tmpdir.join('test_a.py').write("def test_a():\n    pass\n")
+    assert watcher.wait(0) == {paths[0]}
+
+
+@pytest.mark.parametrize('watcher_class', [PollingWatcher, InotifyWatcher])
+def test_watcher(watcher_class, tmpdir):
+    """Test that a watcher reports the python files written under a tree, including new directories
+
+    inotify queues an event before the write returns and polling scans once, so nothing waits on the clock.
+    """
+
+    try:
+        watcher = watcher_class(tmpdir.strpath)
+    except OSError:
+        pytest.skip("inotify is not available")
+    try:
+        assert watcher.wait(0) == set()
+        tmpdir.join('test_foo.py').write("def test_foo():\n    pass\n")
+        tmpdir.join('notes.txt').write("not python")
+        assert watcher.wait(0) == {tmpdir.join('test_foo.py').strpath}
+        tmpdir.mkdir('sub').join('test_bar.py').write("def test_bar():\n    pass\n")
+        assert watcher.wait(0) == {tmpdir.join('sub', 'test_bar.py').strpath}
+        assert watcher.wait(0) == set()
+    finally:
+        watcher.close()
+
+
+def test_polling_watcher_timeout(tmpdir):
+    """Test that polling sleeps an interval at a time until the timeout or a change, on an injected clock"""
+
+    now = [0.0]
+    slept = []
+
+    def sleep(seconds):
+        slept.append(seconds)
+        now[0] += seconds
+
+    watcher = PollingWatcher(tmpdir.strpath, interval=1, clock=lambda: now[0], sleep=sleep)
+    assert watcher.wait(2.5) == set()
+    assert slept == [1, 1, 0.5]
+
+    def write_while_sleeping(seconds):
+        sleep(seconds)
+        tmpdir.join('test_foo.py').write("def test_foo():\n    pass\n")
+
+    del slept[:]
+    watcher._sleep = write_while_sleeping
+    assert watcher.wait(None) == {tmpdir.join('test_foo.py').strpath}
+    assert slept == [1]
+
+
+def test_iter_batches(tmpdir):
+    """Test that changes following each other within the debounce make a single batch of the files still there"""
+
+    first, second, gone = (tmpdir.join(name) for name in ('test_a.py', 'test_b.py', 'test_gone.py'))
+    first.write('')
+    second.write('')
+
+    class ScriptedWatcher(object):
+        script = [(None, {first.strpath}), (0.3, {second.strpath, gone.strpath}), (0.3, {first.strpath}),
+                  (0.3, set()), (None, {gone.strpath}), (0.3, set()), (None, {second.strpath}), (0.3, set())]
+
+        def wait(self, timeout):
+            expected, changed = self.script.pop(0)
+            assert timeout == expected
+            return set(changed)
+
+    batches = magic_marker.watch.iter_batches(ScriptedWatcher(), debounce=0.3)
+
+    assert next(batches) == sorted([first.strpath, second.strpath])
+    assert next(batches) == [second.strpath]  # the batch of the file deleted since was skipped
+
+
+def test_watch(one_test_unmarked, original_behavior_config, uuid_patch, mocker):
+    """Test that watching loads the configuration once and skips the files it just fixed itself"""
+
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+    mocker.patch('magic_marker.watch.make_watcher')
+    mocker.patch('magic_marker.watch.iter_batches', return_value=iter([[one_test_unmarked.path]] * 2))
+    spy = mocker.spy(Application, 'initialize')
+    messages = []
+    mm = MagicMarker(jobs=1)
+    first_backup = mm.backup_path
+
+    mm.watch(os.path.dirname(one_test_unmarked.path), original_behavior_config, messages.append)
+
+    assert len(messages) == 1
+    assert "one_test_unmarked.py : 1 test mark added" in messages[0]
+    assert spy.call_count == 1
+    assert os.path.exists(first_backup) and mm.backup_path != first_backup
+    with open(one_test_unmarked.path, 'r') as f:
+        assert f.read() == one_test_unmarked.expected
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason="serving needs python 3.5 or later")
+def test_serve(one_test_unmarked, original_behavior_config, uuid_patch, mocker, tmpdir):
+    """Test marking files and source buffers through the server, with the configuration loaded once"""
+
+    from magic_marker.server import MarkServer
+    mocker.patch('uuid.uuid1', return_value=uuid_patch)
+    spy = mocker.spy(Application, 'initialize')
+    socket_path = tmpdir.join('server.sock').strpath
+    root = os.path.dirname(one_test_unmarked.path)
+    server = MarkServer(MagicMarker(jobs=1), original_behavior_config, socket_path, root)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        for _ in range(100):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.05)
+
+        response = client.request(socket_path, {'command': 'mark_source', 'source': one_test_unmarked.original})
+        assert response == {'ok': True, 'source': one_test_unmarked.expected, 'marks_added': 1}
+
+        response = client.request(socket_path, {'command': 'mark', 'files': [one_test_unmarked.path]})
+        assert response['ok'] and "one_test_unmarked.py : 1 test mark added" in response['message']
+        assert os.path.exists(response['backup'])
+        with open(one_test_unmarked.path, 'r') as f:
+            assert f.read() == one_test_unmarked.expected
+
+        response = client.request(socket_path, {'command': 'mark', 'files': [tmpdir.join('elsewhere.py').strpath]})
+        assert not response['ok'] and 'only marks the files under' in response['error']
+        assert client.request(socket_path, {'command': 'guess'})['ok'] is False
+
+        response = client.request(socket_path, {'command': 'status'})
+        assert response['ok'] and response['requests'] == 4 and response['root'] == root
+        assert spy.call_count == 1
+    finally:
+        server.stop()
+        thread.join()
+    assert not os.path.exists(socket_path)
+
+
+@pytest.mark.parametrize('nesting', [0, 2])
+def test_synthetic_tree(nesting, tmpdir):
+    """Test that the benchmarks generate the tree they describe and report comparable results"""
+
+    shape = TreeShape(files=3, tests_per_file=5, marked=0.4, nesting=nesting, files_per_dir=2)
+    tree = make_tree(tmpdir.join('tree').strpath, shape)
+    mm = MagicMarker(engine='ast', jobs=1)
+    mm.find_options(tree['config'])
+
+    assert len(tree['files']) == 3 and tree['tests'] == 15
+    assert 0 < tree['unmarked'] < 15
+    violations = AstDetector(mm.options).detect(tmpdir.join('tree').strpath)
+    assert sum(len(v) for v in violations.values()) == tree['unmarked']
+    assert make_tree(tmpdir.join('again').strpath, shape)['unmarked'] == tree['unmarked']
+
+    results = benchmarks.run_benchmarks(shape, repeat=1, only=['mark[ast]', 'fix_file'])
+    assert [r['name'] for r in results['results']] == ['mark[ast]', 'fix_file']
+    assert results['results'][1]['units'] == tree['unmarked']
+    assert 'mark[ast]' in benchmarks.format_results(results, results)